@@ -0,0 +1,286 @@
+import os
+import sys
+import argparse
+import json
+import glob
+import platform
+import shlex
+import socket
+import subprocess
+import tarfile
+import threading
+import time
+
+from collections import deque
+from datetime import datetime
+from urllib.request import urlopen
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+env = os.environ.get
+
+parser = argparse.ArgumentParser(description="Runs the auto_bench.sh model benchmarks concurrently across devices / CPU sets, skipping results that already exist")
+parser.add_argument('label', type=str, help='Results label, eg NVIDIA_2080TI')
+parser.add_argument('-w', '--workdir', type=str, default='.', help='CVEDIA-RT install with run.sh, results are written to its persist/ folder')
+parser.add_argument('-I', '--install', type=str, default=None, help='CVEDIA-RT tarball url extracted into --workdir when run.sh is missing, eg https://bin.cvedia.com/2023.1.0/Linux-2023.1.0.tar.gz')
+parser.add_argument('--run_sh', type=str, default='./run.sh', help='Script run for every benchmark, relative to --workdir; a stub can stand in for testing')
+parser.add_argument('-m', '--models', type=str, default=None, help='Models file: yaml / json list of { uri, params } or text with one model uri and optional benchmark params per line. Defaults to the auto_bench.sh models')
+parser.add_argument('-t', '--tests', type=str, default='bs1,bsx,bll', help='Comma separated test modes: bs1, bsx, bll')
+parser.add_argument('-D', '--devices', type=str, default=env('DEVICE_INDEX', '0'), help='Comma separated device indices, one benchmark runs on every device at a time')
+parser.add_argument('-c', '--cpusets', type=str, default=None, help='Comma separated taskset cpu lists (eg 0-3,4-7), one per device or one per slot on a single device')
+parser.add_argument('-r', '--retries', type=int, default=1, help='Times a failed benchmark is retried')
+parser.add_argument('-n', '--dry_run', default=False, action='store_true', help='Only print the benchmarks that would run')
+parser.add_argument('--tag', type=str, default=env('TAG', f'cvedia/public:runtime-{platform.machine()}-public-2023.1.0'), help='Docker image')
+parser.add_argument('--backend', type=str, default=env('BACKEND', 'tensorrt.1'), help='Inference backend')
+parser.add_argument('--duration', type=int, default=int(env('TEST_DURATION', 60)), help='Seconds every benchmark runs')
+parser.add_argument('--warmup', type=int, default=int(env('TEST_WARMUP', 5)), help='Warmup seconds')
+parser.add_argument('--bsx_me', type=int, default=int(env('OPT_ME', 3)), help='Batch size search depth for bsx')
+parser.add_argument('--bll_me', type=int, default=int(env('OPT_ME', 10)), help='Batch size search depth for bll')
+parser.add_argument('--run_params', type=str, default=env('RUN_PARAMS', ''), help='Extra run.sh options')
+parser.add_argument('-p', '--publish', type=str, default=None, help='Upload the results tarball to this url')
+
+args = parser.parse_args()
+
+# model uri, extra benchmark params
+MODELS = [(m, '') for m in [
+    '3dbbox_reg/rgb/default_64x64/220907', 'cuav_classifier/rgb_thermal/default/211116b', 'cuav_ufo_det/rgb_thermal/medium/220222b',
+    'face_det/rgb/10g_512x512/221018', 'packages_detector/rgb/default/220506b', 'par_classifier/rgb/resnet34_224_224/220325b',
+    'people_det/rgb/tiny/221221b', 'people_fallen_classifier/rgb/normal/221221b', 'pva_classifier/rgb/default/220318b',
+    'pva_classifier/rgb/resnet18_64x64/220826', 'pva_classifier/thermal/resnet18_64x64/220620', 'pva_det/rgb_aerial/medium_512x512/221214',
+    'pva_det/rgb_ground/medium_512x512/220330', 'pva_det/rgb_gs/nano_160x160/220527b', 'pva_det/rgb/medium_1280x736/230118',
+    'pva_det/rgb/medium_512x512/230124', 'pva_det/rgb/small_320x320/221123', 'pva_det/rgb/small_320x320_aerial/221128',
+    'pva_det/rgb/small_320x320_ground/221129', 'pva_det/thermal/medium/220307b', 'pva_det/thermal/medium_512x512/220413b',
+    'pva_det/thermal/medium_512x512/220728', 'vehicle_model_classifier/rgb_thermal/resnet18_128x128/221021',
+    'vehicle_model_classifier/rgb_thermal/resnet18_128x128/221122',
+]] + [
+    # models which need the size specified
+    ('crowd_detection/rgb/mae_749/220930', '--width 1280 --height 720'),
+]
+
+TESTS = {
+    'bs1': '',
+    'bsx': f'-o 10 -M {args.bsx_me} -S thruput',
+    'bll': f'-o 10 -M {args.bll_me} -S latency',
+}
+
+# persist/ as seen from within the container
+CONTAINER_PERSIST = '/opt/cvedia-rt/persist'
+
+def load_models(fn):
+    with open(fn) as f:
+        if fn.endswith('.yaml') or fn.endswith('.yml'):
+            if yaml is None:
+                print('-- yaml files require pyyaml: python3 -m pip install pyyaml')
+                sys.exit(1)
+            rows = yaml.safe_load(f) or []
+        elif fn.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = []
+            for line in f:
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    uri, _, params = line.partition(' ')
+                    rows.append({ 'uri': uri, 'params': params.strip() })
+
+    return [(r, '') if isinstance(r, str) else (r['uri'], r.get('params') or '') for r in rows]
+
+def make_slots():
+    # (device index, cpu set) of every concurrently running benchmark
+    devices = [d.strip() for d in args.devices.split(',') if d.strip()]
+    cpusets = [c.strip() for c in args.cpusets.split(',') if c.strip()] if args.cpusets else []
+
+    if len(cpusets) == 0:
+        return [(d, None) for d in devices]
+    if len(devices) == 1:
+        return [(devices[0], c) for c in cpusets]
+    if len(devices) != len(cpusets):
+        print(f'-- Got {len(devices)} devices and {len(cpusets)} cpu sets, expected one cpu set per device')
+        sys.exit(1)
+    return list(zip(devices, cpusets))
+
+def is_complete(fn):
+    # results are written at the end, an interrupted benchmark leaves nothing or a partial file
+    try:
+        with open(fn) as f:
+            return len(json.load(f)) > 0
+    except (OSError, ValueError, TypeError):
+        return False
+
+def run_flags(slots):
+    # deleting the model cache under a running benchmark breaks it
+    return '-UCEPM' if len(slots) == 1 else '-UEPM'
+
+class Job:
+    def __init__(self, prefix, test, uri, params):
+        self.test = test
+        self.uri = uri
+        self.params = params
+        self.name = f'{prefix}_{test}_{uri.replace("/", "_")}.json'
+        self.attempts = 0
+
+    def command(self, slot, run_flags):
+        device, cpuset = slot
+        cmd = [args.run_sh, '--disable_mqtt', run_flags, 'benchmark', '-t', args.tag]
+        if cpuset is not None:
+            cmd += ['--taskset', cpuset]
+        cmd += shlex.split(args.run_params)
+        cmd += ['--', '-e', f'CUDA_VISIBLE_DEVICES={device}', '-e', f'DEVICE_INDEX={device}', '-e', f'NVIDIA_VISIBLE_DEVICES={device}']
+        cmd += ['--', '-u', f'{args.backend}://{self.uri}', '-n', '1000000'] + shlex.split(TESTS[self.test])
+        cmd += ['-w', str(args.warmup), '-d', str(args.duration), '-i', '5'] + shlex.split(self.params)
+        cmd += ['-j', f'{CONTAINER_PERSIST}/{self.name}']
+        return cmd
+
+class Scheduler:
+    """Runs the jobs on a thread per slot, failed jobs go back to the queue until out of retries."""
+
+    def __init__(self, jobs, slots, persist):
+        self.pending = deque(jobs)
+        self.slots = slots
+        self.persist = persist
+        self.logs = os.path.join(persist, 'logs')
+        self.run_flags = run_flags(slots)
+        self.cond = threading.Condition()
+        self.running = 0
+        self.completed = []
+        self.failed = []
+
+    def run_job(self, job, slot):
+        fn = os.path.join(self.persist, job.name)
+        if os.path.exists(fn):
+            os.remove(fn)
+
+        cmd = job.command(slot, self.run_flags)
+        started = time.monotonic()
+        with open(os.path.join(self.logs, job.name[:-5] + '.log'), 'ab') as log:
+            log.write(f'{datetime.now()} -- Running: {shlex.join(cmd)}\n'.encode())
+            log.flush()
+            rt = subprocess.call(cmd, cwd=args.workdir, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+        ok = rt == 0 and is_complete(fn)
+        print(f'{datetime.now()} -- [{slot[0]}{"/" + slot[1] if slot[1] else ""}] {job.test} {job.uri}: '
+              f'{"completed" if ok else f"failed with exit code {rt}"} in {time.monotonic() - started:.0f}s')
+        return ok
+
+    def worker(self, slot):
+        while True:
+            with self.cond:
+                # a running job may still fail and be queued again
+                while len(self.pending) == 0 and self.running > 0:
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    return
+                job = self.pending.popleft()
+                job.attempts += 1
+                self.running += 1
+
+            try:
+                ok = self.run_job(job, slot)
+            except OSError as e:
+                print(f'-- {job.name}: {e}')
+                ok = False
+
+            with self.cond:
+                self.running -= 1
+                if ok:
+                    self.completed.append(job)
+                elif job.attempts <= args.retries:
+                    self.pending.append(job)
+                else:
+                    self.failed.append(job)
+                self.cond.notify_all()
+
+    def run(self):
+        os.makedirs(self.logs, exist_ok=True)
+        threads = [threading.Thread(target=self.worker, args=(slot,), daemon=True) for slot in self.slots]
+        for t in threads:
+            t.start()
+        for t in threads:
+            # joined with a timeout so ctrl+c gets through
+            while t.is_alive():
+                t.join(1)
+
+def install():
+    if os.path.exists(os.path.join(args.workdir, args.run_sh)):
+        return
+    if args.install is None:
+        print(f'-- {args.run_sh} not found in {args.workdir}, point --workdir to a CVEDIA-RT install or set --install')
+        sys.exit(1)
+
+    print(f'-- Installing {args.install} to {args.workdir}...')
+    os.makedirs(args.workdir, exist_ok=True)
+    with urlopen(args.install) as r, tarfile.open(fileobj=r, mode='r|gz') as tar:
+        tar.extractall(args.workdir)
+
+def publish(persist, prefix):
+    results = [fn for fn in glob.glob(os.path.join(persist, '*.json')) if os.path.basename(fn) != 'rtshm.json']
+    if len(results) == 0:
+        print('-- No valid metrics to publish')
+        return None
+
+    ofn = os.path.join(persist, f'{prefix}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.tar.gz')
+    with tarfile.open(ofn, 'w:gz') as tar:
+        for fn in sorted(results):
+            tar.add(fn, arcname=f'./{os.path.basename(fn)}')
+    print(f'-- {len(results)} results written to {ofn}')
+
+    if args.publish is not None:
+        for k in range(5):
+            if subprocess.call(['curl', '-sk', f'-Ffile=@{ofn}', args.publish]) == 0:
+                print('\n-- Metrics published')
+                break
+            print('\n-- Failed to publish metrics, retrying...')
+            time.sleep(5)
+    return ofn
+
+def run():
+    tests = [t.strip() for t in args.tests.split(',') if t.strip()]
+    for t in tests:
+        if t not in TESTS:
+            print(f'-- Unknown test: {t}, expected any of: {", ".join(TESTS)}')
+            sys.exit(1)
+
+    models = load_models(args.models) if args.models is not None else MODELS
+    slots = make_slots()
+    prefix = f'{socket.gethostname()}_{args.label}'
+    persist = os.path.join(args.workdir, 'persist')
+
+    jobs = [Job(prefix, t, uri, params) for t in tests for uri, params in models]
+    pending = [job for job in jobs if not is_complete(os.path.join(persist, job.name))]
+    print(f'-- TAG: {args.tag} PREFIX: {prefix} TESTS: {" ".join(tests)} SLOTS: {len(slots)}')
+    print(f'-- {len(pending)} of {len(jobs)} benchmarks to run, {len(jobs) - len(pending)} already completed')
+
+    if len(pending) == 0:
+        # the results were packaged by the run that completed them
+        return
+
+    if args.dry_run:
+        for job in pending:
+            print('   ' + shlex.join(job.command(slots[0], run_flags(slots))))
+        return
+
+    install()
+    os.makedirs(persist, exist_ok=True)
+
+    started = time.monotonic()
+    scheduler = Scheduler(pending, slots, persist)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print(f'-- Interrupted, {len(scheduler.completed)} benchmarks completed, run again to resume')
+        sys.exit(1)
+
+    print(f'-- Completed {len(scheduler.completed)}/{len(pending)} benchmarks in {time.monotonic() - started:.0f}s, {len(scheduler.failed)} failed')
+    for job in scheduler.failed:
+        print(f'   {job.test} {job.uri}: see {os.path.join(scheduler.logs, job.name[:-5] + ".log")}')
+
+    if len(scheduler.completed) > 0:
+        publish(persist, prefix)
+    if len(scheduler.failed) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,273 @@
+import os
+import re
+import sys
+import argparse
+import csv
+import json
+import tarfile
+
+from array import array
+
+parser = argparse.ArgumentParser(description="Aggregates auto_bench.sh results from tarballs / directories and flags regressions against a baseline")
+parser.add_argument('paths', type=str, nargs='+', help='Result tarballs, directories (searched recursively) or json files')
+parser.add_argument('-B', '--baseline', type=str, default=None, help='Baseline table written by --save to compare against')
+parser.add_argument('-s', '--save', type=str, default=None, help='Write the aggregated table to this file, use it as a later --baseline')
+parser.add_argument('-o', '--output', type=str, default=None, help='Write the aggregated table as CSV')
+parser.add_argument('-t', '--threshold', type=float, default=5, help='Percent drop in fps / rise in latency flagged as a regression')
+parser.add_argument('-k', '--key', type=str, default='host,label,backend,test,model',
+                    help='Comma separated columns identifying a result when comparing, eg label,backend,test,model to compare across hosts')
+parser.add_argument('--backend', type=str, default='unknown', help='Backend for results that do not report one')
+parser.add_argument('--fps_key', type=str, default=None, help='Path to the throughput in the result json, eg summary/fps. Found by name when not set')
+parser.add_argument('--latency_key', type=str, default=None, help='Path to the latency in the result json, eg summary/latency_ms. Found by name when not set')
+parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Enable verbose mode')
+
+args = parser.parse_args()
+
+TESTS = ['bs1', 'bsx', 'bll']
+# ${hostname}_${label}_${test}_${model with / replaced by _}.json
+RESULT_NAME = re.compile(r'^(?P<prefix>.+?)_(?P<test>' + '|'.join(TESTS) + r')_(?P<model>.+)\.json$')
+TARBALLS = ('.tar.gz', '.tgz', '.tar')
+# ${hostname}_${label}_%Y%m%d_%H%M%S.tar.gz
+TARBALL_RUN = re.compile(r'_(?P<run>\d{8}_\d{6})\.')
+
+FPS_NAMES = ['fps', 'throughput', 'ips', 'inferences_per_second', 'avg_fps', 'mean_fps']
+LATENCY_NAMES = ['latency_ms', 'latency', 'avg_latency', 'mean_latency', 'latency_avg', 'latency_mean']
+AVERAGE_NAMES = ['avg', 'mean', 'average', 'p50', 'median']
+
+STRING_COLUMNS = ['host', 'label', 'backend', 'test', 'model', 'run']
+NUMBER_COLUMNS = ['fps', 'latency_ms']
+
+class Table:
+    """Columnar results, strings are dictionary encoded and numbers kept in float arrays."""
+
+    def __init__(self):
+        self.values = { c: [] for c in STRING_COLUMNS }
+        self.lookup = { c: {} for c in STRING_COLUMNS }
+        self.codes = { c: array('I') for c in STRING_COLUMNS }
+        self.numbers = { c: array('d') for c in NUMBER_COLUMNS }
+
+    def __len__(self):
+        return len(self.codes['host'])
+
+    def encode(self, column, value):
+        value = '' if value is None else str(value)
+        code = self.lookup[column].get(value)
+        if code is None:
+            code = self.lookup[column][value] = len(self.values[column])
+            self.values[column].append(value)
+        return code
+
+    def append(self, row):
+        for c in STRING_COLUMNS:
+            self.codes[c].append(self.encode(c, row.get(c)))
+        for c in NUMBER_COLUMNS:
+            self.numbers[c].append(float('nan') if row.get(c) is None else float(row[c]))
+
+    def row(self, k):
+        out = { c: self.values[c][self.codes[c][k]] for c in STRING_COLUMNS }
+        for c in NUMBER_COLUMNS:
+            value = self.numbers[c][k]
+            out[c] = None if value != value else value
+        return out
+
+    def rows(self):
+        for k in range(len(self)):
+            yield self.row(k)
+
+    def dump(self, fn):
+        with open(fn, 'w') as f:
+            json.dump({
+                'values': self.values,
+                'codes': { c: list(v) for c, v in self.codes.items() },
+                'numbers': { c: [None if x != x else x for x in v] for c, v in self.numbers.items() },
+            }, f)
+
+    @staticmethod
+    def load(fn):
+        with open(fn) as f:
+            data = json.load(f)
+        table = Table()
+        for c in STRING_COLUMNS:
+            table.values[c] = data['values'][c]
+            table.lookup[c] = { v: k for k, v in enumerate(table.values[c]) }
+            table.codes[c] = array('I', data['codes'][c])
+        for c in NUMBER_COLUMNS:
+            table.numbers[c] = array('d', [float('nan') if x is None else x for x in data['numbers'][c]])
+        return table
+
+def get_path(data, path):
+    for key in path.split('/'):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+def find(data, names, predicate):
+    # breadth first so top level summaries win over per iteration values
+    pending = [data]
+    while len(pending) > 0:
+        node = pending.pop(0)
+        items = node.items() if isinstance(node, dict) else enumerate(node) if isinstance(node, list) else []
+        for k, v in items:
+            if isinstance(k, str) and k.lower() in names and predicate(v):
+                return v
+            if isinstance(v, (dict, list)):
+                pending.append(v)
+    return None
+
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def number(data, path, names):
+    if path is not None:
+        value = get_path(data, path)
+        return value if is_number(value) else None
+
+    value = find(data, names, lambda v: is_number(v) or isinstance(v, dict))
+    if isinstance(value, dict):
+        # eg latency: { avg, p50, p99 }
+        value = find(value, AVERAGE_NAMES, is_number)
+    return value
+
+def parse_result(name, data, run):
+    # returns the row of a result json, None when the name doesn't match the auto_bench.sh naming
+    m = RESULT_NAME.match(os.path.basename(name))
+    if m is None:
+        return None
+
+    prefix = m.group('prefix')
+    # hostnames have no underscores, labels may
+    host, _, label = prefix.partition('_')
+
+    # the model uri holds the backend and the model path with its slashes
+    uri = find(data, ['uri', 'model', 'model_uri'], lambda v: isinstance(v, str) and '://' in v)
+    backend, model = uri.split('://', 1) if uri is not None else (args.backend, m.group('model'))
+
+    return {
+        'host': host,
+        'label': label,
+        'backend': backend,
+        'test': m.group('test'),
+        'model': model,
+        'run': run,
+        'fps': number(data, args.fps_key, FPS_NAMES),
+        'latency_ms': number(data, args.latency_key, LATENCY_NAMES),
+    }
+
+def read_results(path):
+    # yields (name, json, run) without extracting anything to disk
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(files):
+                yield from read_results(os.path.join(root, fn))
+        return
+
+    if path.endswith(TARBALLS):
+        m = TARBALL_RUN.search(os.path.basename(path))
+        run = m.group('run') if m is not None else os.path.basename(path)
+        # streamed, members are read in order once
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith('.json'):
+                    continue
+                try:
+                    yield member.name, json.load(tar.extractfile(member)), run
+                except ValueError as e:
+                    print(f'-- Skipping {path}:{member.name}: {e}')
+        return
+
+    if path.endswith('.json'):
+        try:
+            with open(path) as f:
+                yield path, json.load(f), ''
+        except ValueError as e:
+            print(f'-- Skipping {path}: {e}')
+
+def aggregate(paths):
+    table = Table()
+    skipped = 0
+    for path in paths:
+        for name, data, run in read_results(path):
+            row = parse_result(name, data, run)
+            if row is None or row['fps'] is None and row['latency_ms'] is None:
+                if args.verbose:
+                    print(f'-- No result found in {path}:{name}')
+                skipped += 1
+                continue
+            table.append(row)
+    return table, skipped
+
+def latest(table, key):
+    # key -> row, later runs replace earlier ones
+    out = {}
+    for row in table.rows():
+        k = tuple(row[c] for c in key)
+        if k not in out or row['run'] >= out[k]['run']:
+            out[k] = row
+    return out
+
+def change(current, base):
+    if current is None or base is None or base == 0:
+        return None
+    return (current - base) / base * 100
+
+def compare(table, baseline, key):
+    # returns the number of regressions
+    current = latest(table, key)
+    previous = latest(baseline, key)
+
+    regressions = []
+    improvements = 0
+    for k, row in sorted(current.items()):
+        b = previous.get(k)
+        if b is None:
+            continue
+        fps = change(row['fps'], b['fps'])
+        latency = change(row['latency_ms'], b['latency_ms'])
+        if (fps is not None and fps < -args.threshold) or (latency is not None and latency > args.threshold):
+            regressions.append((k, row, b, fps, latency))
+        elif (fps is not None and fps > args.threshold) or (latency is not None and latency < -args.threshold):
+            improvements += 1
+
+    fmt = lambda v: 'n/a' if v is None else f'{v:+.1f}%'
+    num = lambda v: 'n/a' if v is None else f'{v:.2f}'
+    for k, row, b, fps, latency in regressions:
+        print(f"   {'/'.join(k)}: fps {num(b['fps'])} -> {num(row['fps'])} ({fmt(fps)}) "
+              f"latency {num(b['latency_ms'])} -> {num(row['latency_ms'])} ms ({fmt(latency)})")
+
+    common = len(set(current) & set(previous))
+    print(f'-- Compared {common} results: {len(regressions)} regressions, {improvements} improvements beyond {args.threshold:g}%, '
+          f'{len(set(current) - set(previous))} new, {len(set(previous) - set(current))} missing')
+    return len(regressions)
+
+def write_csv(table, fn):
+    with open(fn, 'w', newline='') as f:
+        writer = csv.DictWriter(f, STRING_COLUMNS + NUMBER_COLUMNS)
+        writer.writeheader()
+        for row in table.rows():
+            writer.writerow(row)
+
+def run():
+    key = [c.strip() for c in args.key.split(',') if c.strip()]
+    for c in key:
+        if c not in STRING_COLUMNS:
+            print(f'-- Unknown key column: {c}, expected any of: {", ".join(STRING_COLUMNS)}')
+            sys.exit(1)
+
+    table, skipped = aggregate(args.paths)
+    hosts = len(set(zip(table.codes['host'], table.codes['label'])))
+    print(f'-- Aggregated {len(table)} results from {hosts} host(s) / label(s), {len(table.values["model"])} models, {skipped} skipped')
+
+    if args.output is not None:
+        write_csv(table, args.output)
+    if args.save is not None:
+        table.dump(args.save)
+        print(f'-- Saved to {args.save}')
+
+    if args.baseline is not None:
+        if compare(table, Table.load(args.baseline), key) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,480 @@
+import os
+import re
+import sys
+import ssl
+import gzip
+import json
+import time
+import socket
+import struct
+import tempfile
+import threading
+import subprocess
+import socketserver
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# local stand-ins for the services the bridges talk to, used by the benchmarks
+
+def percentile(values, p):
+    # values must be sorted
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class Recorder:
+    """Matches delivered messages with their publish time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = {}
+        self.latencies = []
+        self.first_published = None
+        self.last_delivered = None
+        self.duplicates = 0
+
+    def publish(self, seq):
+        now = time.monotonic()
+        with self.lock:
+            self.published[seq] = now
+            if self.first_published is None:
+                self.first_published = now
+
+    def deliver(self, seq):
+        now = time.monotonic()
+        with self.lock:
+            started = self.published.pop(seq, None)
+            if started is None:
+                self.duplicates += 1
+                return
+            self.latencies.append(now - started)
+            self.last_delivered = now
+
+    def delivered(self):
+        with self.lock:
+            return len(self.latencies)
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            delivered = len(latencies)
+            elapsed = (self.last_delivered - self.first_published) if delivered > 0 else 0
+            ms = lambda v: None if v is None else round(v * 1000, 2)
+            return {
+                'delivered': delivered,
+                'undelivered': len(self.published),
+                'duplicates': self.duplicates,
+                'msgs_per_s': round(delivered / elapsed, 1) if elapsed > 0 else None,
+                'latency_ms': {
+                    'p50': ms(percentile(latencies, 50)),
+                    'p99': ms(percentile(latencies, 99)),
+                    'max': ms(latencies[-1] if delivered > 0 else None),
+                },
+            }
+
+def topic_matches(pattern, topic):
+    pl = pattern.split('/')
+    tl = topic.split('/')
+    if topic.startswith('$') and pl[0] in ['+', '#']:
+        return False
+    for k, p in enumerate(pl):
+        if p == '#':
+            return True
+        if k >= len(tl) or (p != '+' and p != tl[k]):
+            return False
+    return len(pl) == len(tl)
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | 0x80 if n > 0 else b)
+        if n == 0:
+            return bytes(out)
+
+def decode_length(data, pos):
+    # variable byte integer at pos, returns it and the position after it
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if b & 0x80 == 0:
+            return n, pos
+
+def read_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError()
+        buf += chunk
+    return bytes(buf)
+
+class BrokerClient:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.packet_id = 0
+        # protocol level from CONNECT, 5 adds properties to most packets
+        self.version = 4
+
+    def send(self, packet):
+        with self.lock:
+            self.sock.sendall(packet)
+
+    def publish(self, topic, payload, qos):
+        topic = topic.encode()
+        header = struct.pack('>H', len(topic)) + topic
+        if qos > 0:
+            with self.lock:
+                self.packet_id = self.packet_id % 65535 + 1
+                header += struct.pack('>H', self.packet_id)
+        if self.version == 5:
+            # no properties
+            header += b'\x00'
+        self.send(bytes([0x30 | qos << 1]) + encode_length(len(header) + len(payload)) + header + payload)
+
+    def serve(self):
+        try:
+            while True:
+                first = read_exact(self.sock, 1)[0]
+                length = 0
+                shift = 0
+                while True:
+                    b = read_exact(self.sock, 1)[0]
+                    length |= (b & 0x7f) << shift
+                    shift += 7
+                    if b & 0x80 == 0:
+                        break
+                body = read_exact(self.sock, length)
+                if not self.handle(first >> 4, first & 0x0f, body):
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.disconnect(self)
+            self.sock.close()
+
+    def handle(self, kind, flags, body):
+        if kind == 1:
+            # CONNECT, session present 0, accepted, no properties with v5
+            self.version = body[2 + struct.unpack('>H', body[:2])[0]]
+            self.send(b'\x20\x03\x00\x00\x00' if self.version == 5 else b'\x20\x02\x00\x00')
+        elif kind == 3:
+            qos = (flags >> 1) & 3
+            topic_len = struct.unpack('>H', body[:2])[0]
+            topic = body[2:2 + topic_len].decode()
+            pos = 2 + topic_len
+            if qos > 0:
+                packet_id = body[pos:pos + 2]
+                pos += 2
+            if self.version == 5:
+                length, pos = decode_length(body, pos)
+                pos += length
+            self.broker.publish(topic, body[pos:], qos)
+            if qos == 1:
+                self.send(b'\x40\x02' + packet_id)
+            elif qos == 2:
+                self.send(b'\x50\x02' + packet_id)
+        elif kind == 6:
+            # PUBREL -> PUBCOMP
+            self.send(b'\x70\x02' + body[:2])
+        elif kind == 8:
+            packet_id = body[:2]
+            pos = 2
+            if self.version == 5:
+                length, pos = decode_length(body, pos)
+                pos += length
+            granted = bytearray()
+            while pos < len(body):
+                topic_len = struct.unpack('>H', body[pos:pos + 2])[0]
+                topic = body[pos + 2:pos + 2 + topic_len].decode()
+                qos = min(body[pos + 2 + topic_len] & 3, 1)
+                pos += 3 + topic_len
+                self.broker.subscribe(self, topic, qos)
+                granted.append(qos)
+            properties = b'\x00' if self.version == 5 else b''
+            self.send(b'\x90' + encode_length(2 + len(properties) + len(granted)) + packet_id + properties + bytes(granted))
+        elif kind == 10:
+            if self.version == 5:
+                # UNSUBACK has a reason code per topic filter with v5
+                length, pos = decode_length(body, 2)
+                pos += length
+                count = 0
+                while pos < len(body):
+                    pos += 2 + struct.unpack('>H', body[pos:pos + 2])[0]
+                    count += 1
+                self.send(b'\xb0' + encode_length(3 + count) + body[:2] + b'\x00' * (1 + count))
+            else:
+                self.send(b'\xb0\x02' + body[:2])
+        elif kind == 12:
+            self.send(b'\xd0\x00')
+        elif kind == 14:
+            return False
+        # PUBACK / PUBREC / PUBCOMP from subscribers are ignored, nothing is redelivered
+        return True
+
+class Broker:
+    """Minimal MQTT 3.1.1 / 5 broker, qos 0 / 1 delivery and $share groups, no retained messages, sessions or v5 properties.
+
+    Good enough to benchmark the bridges without a mosquitto install, a
+    subscriber that can't keep up blocks the publishers like TCP would.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = socket.create_server((host, port))
+        self.host = host
+        self.port = self.server.getsockname()[1]
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.routes = {}
+        self.turn = 0
+
+    def start(self):
+        threading.Thread(target=self.accept, name='broker', daemon=True).start()
+        return self
+
+    def accept(self):
+        while True:
+            sock, addr = self.server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=BrokerClient(self, sock).serve, name='broker-client', daemon=True).start()
+
+    def subscribe(self, client, pattern, qos):
+        # $share/<group>/<filter>, every message goes to one member of the group
+        group = None
+        if pattern.startswith('$share/'):
+            _, group, pattern = pattern.split('/', 2)
+        with self.lock:
+            self.subscriptions.append((client, pattern, qos, group))
+            self.routes = {}
+
+    def disconnect(self, client):
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s[0] is not client]
+            self.routes = {}
+
+    def subscribers(self, topic):
+        with self.lock:
+            if topic not in self.routes:
+                plain = []
+                groups = {}
+                for c, p, q, g in self.subscriptions:
+                    if not topic_matches(p, topic):
+                        continue
+                    if g is None:
+                        plain.append((c, q))
+                    else:
+                        groups.setdefault((g, p), []).append((c, q))
+                self.routes[topic] = (plain, list(groups.values()))
+
+            plain, groups = self.routes[topic]
+            if len(groups) == 0:
+                return plain
+            # shared subscriptions are served round robin
+            self.turn += 1
+            return plain + [members[self.turn % len(members)] for members in groups]
+
+    def publish(self, topic, payload, qos):
+        for client, sub_qos in self.subscribers(topic):
+            try:
+                client.publish(topic, payload, min(qos, sub_qos))
+            except OSError:
+                pass
+
+class HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, nagle would delay every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        status, data = self.server.handler(self.command, self.path, self.headers, body)
+        out = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    do_GET = respond
+    do_POST = respond
+    do_PATCH = respond
+    do_PUT = respond
+    do_DELETE = respond
+
+class HttpServer(ThreadingHTTPServer):
+    """Keep-alive HTTP server, `handler(method, path, headers, body)` returns (status, json)."""
+
+    daemon_threads = True
+
+    def __init__(self, handler, host='127.0.0.1', port=0):
+        super().__init__((host, port), HttpHandler)
+        self.handler = handler
+        self.port = self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='http', daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # bridges are stopped mid request at the end of every run
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def rest_server(recorder, field='frame_id'):
+    # REST API accepting every POST, messages are matched by `field`. Every mqtt2rest encoding is accepted:
+    # json or raw json bodies, newline delimited or msgpack batches, gzip or zstd compressed (msgpack / zstd
+    # require their packages)
+    def handler(method, path, headers, body):
+        try:
+            if headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            elif headers.get('Content-Encoding') == 'zstd':
+                body = zstandard.ZstdDecompressor().decompress(body)
+            if headers.get('Content-Type') == 'application/x-ndjson':
+                messages = [json.loads(line) for line in body.splitlines() if line.strip()]
+            elif headers.get('Content-Type') == 'application/msgpack':
+                messages = msgpack.unpackb(body)
+                if not isinstance(messages, list):
+                    messages = [messages]
+            else:
+                messages = [json.loads(body)]
+            for data in messages:
+                recorder.deliver(data[field])
+        except:
+            return 400, { 'error': 'invalid payload' }
+        return 200, { 'ok': True }
+    return HttpServer(handler)
+
+def nxwitness_server(recorder):
+    # NX Witness API, bookmarks are matched by their `bench-<seq>` description
+    def handler(method, path, headers, body):
+        if method == 'POST' and path.endswith('/bookmarks'):
+            try:
+                recorder.deliver(int(json.loads(body)['description'].split('-')[-1]))
+            except:
+                pass
+            return 200, { 'id': 'bench' }
+        return 200, { 'id': 'bench' }
+    return HttpServer(handler)
+
+def frame_server(delay=0, channels=3):
+    # CVEDIA-RT /api/run onFrame, raw frames must be width * height * channels bytes; delay stands in for the inference
+    def handler(method, path, headers, body):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        if method != 'POST' or url.path != '/api/run' or query.get('function') != ['onFrame']:
+            return 404, { 'error': 'not found' }
+        try:
+            expected = int(query['width'][0]) * int(query['height'][0]) * channels
+        except:
+            expected = None
+        if expected is None or 'solution' not in query or 'instance_name' not in query:
+            return 400, { 'error': 'missing solution, instance_name, width or height' }
+        if len(body) != expected:
+            return 400, { 'error': f'expected {expected} bytes, got {len(body)}' }
+        if delay > 0:
+            time.sleep(delay)
+        return 200, { 'ok': True }
+    return HttpServer(handler)
+
+def self_signed_context():
+    # STARTTLS needs a certificate, smtplib doesn't verify it
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with tempfile.TemporaryDirectory() as path:
+        cert = os.path.join(path, 'bench.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                        '-keyout', cert, '-out', cert], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        context.load_cert_chain(cert)
+    return context
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply('220 localhost bench')
+        tls = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250-localhost' + ('' if tls else '\r\n250-STARTTLS') + '\r\n250 AUTH PLAIN LOGIN')
+            elif command.startswith('STARTTLS'):
+                self.reply('220 ready')
+                self.connection = self.server.context.wrap_socket(self.connection, server_side=True)
+                self.rfile = self.connection.makefile('rb')
+                self.wfile = self.connection.makefile('wb')
+                tls = True
+            elif command.startswith('AUTH'):
+                self.reply('235 authenticated')
+            elif command.startswith('DATA'):
+                self.reply('354 go ahead')
+                data = bytearray()
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    data += line
+                self.server.handler(bytes(data))
+                self.reply('250 queued')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+class SmtpServer(socketserver.ThreadingTCPServer):
+    """SMTP server with STARTTLS and any AUTH accepted, `handler` gets every email."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, host='127.0.0.1', port=0):
+        super().__init__((host, port), SmtpHandler)
+        self.handler = handler
+        self.port = self.server_address[1]
+        self.context = self_signed_context()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='smtp', daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionError, ssl.SSLError)):
+            super().handle_error(request, client_address)
+
+def smtp_server(recorder):
+    # emails are matched by the frame id in their body
+    pattern = re.compile(rb'NVR NAME:\s+(\d+)')
+    def handler(data):
+        for match in pattern.finditer(data):
+            recorder.deliver(int(match.group(1)))
+    return SmtpServer(handler)
@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import time
+import socket
+import secrets
+import hashlib
+import signal
+import importlib
+import threading
+import multiprocessing
+
+from datetime import datetime
+from paho.mqtt import client as mqtt_client
+
+import delivery_queue
+import metrics
+
+from collections import deque
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from delivery_queue import DeliveryQueue, ShardedQueue, BLOCK
+from topic_router import TopicRouter
+from payload import LARGE_FIELDS, decode, project
+
+# sink type -> module:class, imported on demand so unused sinks don't need their dependencies
+SINKS = {
+    'rest': 'rest_sink:RestSink',
+    'smtp': 'smtp_sink:SmtpSink',
+    'nxwitness': 'nxwitness_sink:NxWitnessSink',
+}
+
+class Sink:
+    """Base class of the bridge sinks.
+
+    Every sink gets its own delivery queue and `workers` threads calling
+    `deliver` with the topic, the decoded message and the raw payload. The
+    decoded message is shared between sinks and must not be modified. Sinks
+    with `sharded` set get a queue per worker and messages with the same
+    `key` are always delivered in order by the same worker.
+
+    `fields` limits the message to the listed top level fields and fields in
+    `raw_fields` may be delivered as a memoryview of the payload, large fields
+    no sink needs decoded aren't parsed at all. Sinks with `raw` set only use
+    the payload bytes and get None instead of the message, payloads only raw
+    sinks accept aren't decoded and needn't be json.
+
+    Sinks with `batch_size` above 1 get `deliver_batch` called instead, with
+    up to `batch_size` (topic, data, payload) tuples collected for at most
+    `batch_linger` seconds.
+
+    Sinks with `deferred` set finish messages after `deliver` returned (eg
+    digests), the bridge refuses them with QoS 1 as messages would be acked
+    before they were sent.
+    """
+
+    sharded = False
+    raw = False
+    raw_fields = ()
+    batch_size = 1
+    batch_linger = 0
+    deferred = False
+
+    def __init__(self, name, workers=1, queue_size=1000, overflow=BLOCK, topics=None, fields=None):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        # restricts the sink to a subset of the bridge topics, + and # wildcards supported
+        self.filter = TopicRouter({ tn: True for tn in topics }) if topics else None
+        self.fields = fields
+        self.pending = None
+
+    def subscriptions(self):
+        # extra topics the bridge has to subscribe to for this sink
+        return []
+
+    def start(self):
+        pass
+
+    def accepts(self, topic):
+        return self.filter is None or self.filter.resolve(topic, False)
+
+    def skips(self, field):
+        # True if the sink doesn't need the field decoded
+        return field in self.raw_fields or (self.fields is not None and field not in self.fields)
+
+    def view(self, payload):
+        # the message as the bridge would deliver it to this sink, eg for payloads replayed from disk
+        cuttable = LARGE_FIELDS + [f for f in self.raw_fields if f not in LARGE_FIELDS]
+        data, raw = decode(payload, [f for f in cuttable if self.skips(f)])
+        return project(data, raw, self.fields, self.raw_fields)
+
+    def key(self, topic, data):
+        return topic
+
+    def deliver(self, topic, data, payload):
+        raise NotImplementedError()
+
+    def deliver_batch(self, items):
+        for topic, data, payload in items:
+            self.deliver(topic, data, payload)
+
+    def forked(self, index):
+        # called in worker process `index` of a multi process bridge, before start
+        pass
+
+def create_sink(config):
+    # config is a dict with the sink `type`, an optional `name` and the sink options
+    config = dict(config)
+    kind = config.pop('type', None)
+    if kind not in SINKS:
+        raise ValueError(f'Unknown sink type: {kind}, must be one of: {", ".join(SINKS.keys())}')
+
+    module, cls = SINKS[kind].split(':')
+    config.setdefault('name', kind)
+    return getattr(importlib.import_module(module), cls)(**config)
+
+def make_client_id(prefix='python-mqtt', stable=False, key=None):
+    # unique across hosts and processes, brokers disconnect the older of two clients with the same id.
+    # persistent sessions are bound to the id, stable ids stay the same across restarts of the same script
+    # and `key` (eg its topics and destination), so bridges of the same script on one host don't collide
+    if stable:
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:8]
+        return f'{prefix}-{socket.gethostname()}-{os.path.splitext(os.path.basename(sys.argv[0]))[0]}-{digest}'
+    return f'{prefix}-{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}'
+
+# persistent sessions outlive a disconnect by this many seconds with MQTT v5
+SESSION_EXPIRY = 7 * 24 * 3600
+
+def create_client(client_id, mqtt_v5=False, clean_session=True, manual_ack=False):
+    # returns the client and whether messages are acked by the caller, paho-mqtt < 2 acks them on receipt
+    kwargs = {}
+    if hasattr(mqtt_client, 'CallbackAPIVersion'):
+        # paho-mqtt 2 takes the callback version first, the 1.x callback signatures work with both
+        kwargs['callback_api_version'] = mqtt_client.CallbackAPIVersion.VERSION1
+
+    if mqtt_v5:
+        # the session is set on connect with v5
+        client = mqtt_client.Client(client_id=client_id, protocol=mqtt_client.MQTTv5, **kwargs)
+    else:
+        client = mqtt_client.Client(client_id=client_id, clean_session=clean_session, protocol=mqtt_client.MQTTv311, **kwargs)
+
+    if manual_ack and hasattr(client, 'manual_ack_set'):
+        client.manual_ack_set(True)
+        return client, True
+    return client, False
+
+class AckTracker:
+    """Acks qos 1 messages once every sink is done with them.
+
+    Every tracked message holds a count of the sinks it is queued to. MQTT
+    requires acks in the order messages were received, a finished message
+    waits for the ones before it but many messages are in flight at once.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.pending = deque()
+        # messages of an earlier connection are never acked, the broker sends them again
+        self.session = 0
+
+    def track(self, mid, qos):
+        # [mid, qos, holds, session], held by the decoder until dispatched
+        entry = [mid, qos, 1, self.session]
+        with self.lock:
+            self.pending.append(entry)
+        return entry
+
+    def hold(self, entry):
+        if entry is not None:
+            with self.lock:
+                entry[2] += 1
+
+    def release(self, entry):
+        if entry is None:
+            return
+        with self.lock:
+            entry[2] -= 1
+            while len(self.pending) > 0 and self.pending[0][2] <= 0:
+                mid, qos, holds, session = self.pending.popleft()
+                if session == self.session:
+                    self.client.ack(mid, qos)
+
+    def reset(self):
+        with self.lock:
+            self.session += 1
+
+class Bridge:
+    """One MQTT subscription fanned out to any number of sinks.
+
+    Messages are handed from the network thread to a decoder queue, decoded
+    once and queued to every sink accepting the topic, projected to the
+    fields the sink asked for.
+    """
+
+    def __init__(self, sinks, topics, host='127.0.0.1', port=1883, username=None, password=None,
+                 client_id=None, queue_size=1000, stats_interval=60, metrics_port=0, metrics_host='0.0.0.0',
+                 share=None, mqtt_v5=False, processes=1, qos=0, persistent=False, max_inflight=100):
+        self.sinks = sinks
+        self.topics = list(topics)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.client_id = client_id or make_client_id()
+        self.stats_interval = stats_interval
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.processes = max(1, processes)
+        # the broker hands every message to one member of the share group
+        self.share = share or ('bridge' if self.processes > 1 else None)
+        self.mqtt_v5 = mqtt_v5
+        self.qos = qos
+        self.persistent = persistent
+        self.max_inflight = max_inflight
+        for sink in sinks:
+            if qos > 0 and sink.deferred:
+                raise ValueError(f'Sink {sink.name} sends messages after they were acked, it can not be used with QoS 1')
+        self.acks = None
+        self.connected_once = False
+        self.decoding = DeliveryQueue(queue_size)
+        # fields worth cutting out of the payload before it is parsed
+        self.cuttable = list(LARGE_FIELDS)
+        for sink in sinks:
+            self.cuttable += [f for f in sink.raw_fields if f not in self.cuttable]
+
+        for sink in sinks:
+            for tn in sink.subscriptions():
+                if tn not in self.topics:
+                    self.topics.append(tn)
+
+    def connect(self) -> mqtt_client:
+        # properties are only passed with MQTT v5
+        def on_connect(client, userdata, flags, rc, properties=None):
+            if rc == 0:
+                print(f"Connected to MQTT Broker @ {self.host}, waiting for messages...")
+                metrics.CONNECTED.set(1)
+                if self.acks is not None:
+                    self.acks.reset()
+                if self.connected_once:
+                    metrics.RECONNECTS.inc('mqtt')
+                self.connected_once = True
+            else:
+                print("Failed to connect, return code %d\n", rc)
+
+        def on_disconnect(client, userdata, rc, properties=None):
+            metrics.CONNECTED.set(0)
+
+        client, manual_ack = create_client(self.client_id, self.mqtt_v5, not self.persistent, self.qos > 0)
+        if manual_ack:
+            self.acks = AckTracker(client)
+        elif self.qos > 0:
+            print('-- paho-mqtt < 2.0 acks messages on receipt, install paho-mqtt>=2.0 to ack them once delivered')
+
+        if self.username != None:
+            client.username_pw_set(self.username, self.password)
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.max_inflight_messages_set(self.max_inflight)
+
+        if self.mqtt_v5:
+            # the broker sends at most max_inflight unacked messages, with 3.1.1 that's a broker setting
+            properties = Properties(PacketTypes.CONNECT)
+            properties.ReceiveMaximum = self.max_inflight
+            if self.persistent:
+                properties.SessionExpiryInterval = SESSION_EXPIRY
+            client.connect(self.host, self.port, clean_start=not self.persistent, properties=properties)
+        else:
+            client.connect(self.host, self.port)
+        return client
+
+    def subscribe(self, client: mqtt_client):
+        def on_message(client, userdata, msg):
+            metrics.MESSAGES_RECEIVED.inc(msg.topic)
+            entry = self.acks.track(msg.mid, msg.qos) if self.acks is not None and msg.qos > 0 else None
+            self.decoding.put(msg.topic, (msg.payload, entry))
+
+        for tn in self.topics:
+            if self.share is not None:
+                tn = f'$share/{self.share}/{tn}'
+            print(f"Subscribing to {tn}...")
+            client.subscribe(tn, self.qos)
+
+        client.on_message = on_message
+
+    def dispatch(self, topic, item):
+        payload, entry = item
+        try:
+            self.fan_out(topic, payload, entry)
+        finally:
+            # the decoder's hold, acked here unless a sink still has the message queued
+            self.release(entry)
+
+    def fan_out(self, topic, payload, entry):
+        sinks = [sink for sink in self.sinks if sink.accepts(topic)]
+        if len(sinks) == 0:
+            return
+
+        decoded = [sink for sink in sinks if not sink.raw]
+        if len(decoded) > 0:
+            cut = [f for f in self.cuttable if all(sink.skips(f) for sink in decoded)]
+            try:
+                data, raw = decode(payload, cut)
+            except:
+                metrics.DECODE_FAILURES.inc(topic)
+                print(f"{datetime.now()} -- Failed to decode `{payload.decode(errors='replace')}` from `{topic}` topic, skipping")
+                # raw sinks still get the payload
+                sinks = [sink for sink in sinks if sink.raw]
+
+        for sink in sinks:
+            view = None if sink.raw else project(data, raw, sink.fields, sink.raw_fields)
+            self.hold(entry)
+            # dropped messages are released by the queue
+            sink.pending.put(topic, (view, payload, entry), sink.key(topic, view))
+
+    def hold(self, entry):
+        if self.acks is not None:
+            self.acks.hold(entry)
+
+    def release(self, entry):
+        if self.acks is not None:
+            self.acks.release(entry)
+
+    def deliver(self, sink, topic, item):
+        try:
+            sink.deliver(topic, item[0], item[1])
+        finally:
+            self.release(item[2])
+
+    def deliver_batch(self, sink, items):
+        try:
+            sink.deliver_batch([(topic, item[0], item[1]) for topic, item in items])
+        finally:
+            for topic, item in items:
+                self.release(item[2])
+
+    def start(self):
+        for sink in self.sinks:
+            try:
+                sink.start()
+            except Exception as e:
+                print(f'-- Failed to start sink {sink.name}: {e}')
+                sys.exit(1)
+
+            discard = lambda item: self.release(item[2])
+            if sink.sharded:
+                sink.pending = ShardedQueue(sink.workers, sink.queue_size, sink.overflow, discard)
+            else:
+                sink.pending = DeliveryQueue(sink.queue_size, sink.overflow, discard)
+
+            if sink.batch_size > 1:
+                deliver = lambda items, sink=sink: self.deliver_batch(sink, items)
+            else:
+                deliver = lambda topic, item, sink=sink: self.deliver(sink, topic, item)
+            delivery_queue.start_workers(sink.pending, deliver, sink.workers, f'{sink.name}-worker', sink.batch_size, sink.batch_linger)
+            delivery_queue.start_reporter(sink.pending, self.stats_interval, sink.name)
+
+        # a single decoder keeps the message order for every sink
+        delivery_queue.start_workers(self.decoding, self.dispatch, 1, 'decoder')
+
+        if self.metrics_port > 0:
+            self.register_metrics()
+            metrics.serve(self.metrics_port, self.metrics_host)
+
+    def queues(self):
+        return [('decoder', self.decoding)] + [(sink.name, sink.pending) for sink in self.sinks]
+
+    def register_metrics(self):
+        # queue depth and counters are read from the queues at scrape time
+        def depth():
+            return { (name, ): pending.qsize() for name, pending in self.queues() }
+
+        def counters():
+            out = {}
+            for name, pending in self.queues():
+                for k, v in pending.stats().items():
+                    if k != 'pending':
+                        out[(name, k)] = v
+            return out
+
+        metrics.Callback('bridge_queue_depth', 'Messages waiting in the queue', 'gauge', ['queue'], depth)
+        metrics.Callback('bridge_queue_messages_total', 'Messages through the queue by outcome: received, delivered, dropped_oldest, dropped_newest, coalesced',
+                         'counter', ['queue', 'outcome'], counters)
+
+    def run(self):
+        if self.processes > 1:
+            self.run_processes()
+            return
+
+        self.start()
+        client = self.connect()
+        self.subscribe(client)
+        client.loop_forever()
+
+    def run_process(self, index):
+        # every process is a complete bridge with its own connection, ids and metrics ports can't be shared
+        self.client_id = f'{self.client_id}-{index}'
+        if self.metrics_port > 0:
+            self.metrics_port += index
+        for sink in self.sinks:
+            sink.forked(index)
+        self.processes = 1
+        threading.Thread(target=self.watch_parent, args=(os.getppid(), ), name='watch-parent', daemon=True).start()
+        self.run()
+
+    def watch_parent(self, parent):
+        # a killed parent can't stop the processes, they'd keep taking their share of the messages
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(1)
+
+    def run_processes(self):
+        # nothing runs in the parent but this loop, failed processes are restarted
+        print(f'-- Starting {self.processes} processes sharing `$share/{self.share}` subscriptions')
+        context = multiprocessing.get_context('fork')
+        workers = [None] * self.processes
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        try:
+            while True:
+                for k, p in enumerate(workers):
+                    if p is not None and p.is_alive():
+                        continue
+                    if p is not None:
+                        print(f'{datetime.now()} -- Process {k} exited with code {p.exitcode}, restarting')
+                    workers[k] = context.Process(target=self.run_process, args=(k, ), name=f'bridge-{k}', daemon=True)
+                    workers[k].start()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for p in workers:
+                if p is not None and p.is_alive():
+                    p.terminate()
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--share', type=str, default=None,
+        help='Subscribe as part of the $share/<group>/ shared subscription group, the broker spreads messages over the group members')
+    parser.add_argument(
+        '--mqtt_v5', default=False, action='store_true',
+        help='Connect with MQTT v5 instead of 3.1.1')
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='Number of bridge processes, more than 1 subscribes to a shared subscription group (--share, defaults to bridge)')
+    parser.add_argument(
+        '--qos', type=int, default=0, choices=[0, 1],
+        help='Subscription QoS, with 1 messages are acked once every sink is done with them (requires paho-mqtt>=2.0)')
+    parser.add_argument(
+        '--persistent', default=False, action='store_true',
+        help='Keep the MQTT session while disconnected, messages published meanwhile are delivered on reconnect. Uses a client ID that stays the same across restarts of the same command, derived from its topics and destination')
+    parser.add_argument(
+        '--max_inflight', type=int, default=100,
+        help='Maximum number of unacked messages, set as receive maximum with MQTT v5, a broker setting with 3.1.1 (max_inflight_messages in mosquitto)')
+    parser.add_argument(
+        '--client_id', type=str, default=None,
+        help='MQTT client ID, generated when not set')
+
+def options(args):
+    return {
+        'share': args.share,
+        'mqtt_v5': args.mqtt_v5,
+        'processes': args.processes,
+        'qos': args.qos,
+        'persistent': args.persistent,
+        'max_inflight': args.max_inflight,
+    }
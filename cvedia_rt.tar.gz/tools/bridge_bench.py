@@ -0,0 +1,262 @@
+import os
+import sys
+import argparse
+import json
+import shlex
+import time
+import platform
+import threading
+import subprocess
+
+from collections import deque
+from datetime import datetime
+from paho.mqtt import client as mqtt_client
+from bridge import create_client
+from mqtt_capture import synthetic_payloads
+
+import bench_services
+
+parser = argparse.ArgumentParser(description="Benchmarks the MQTT bridges end to end against a local broker and stand-in REST / SMTP / NX Witness servers")
+parser.add_argument(
+    '-b', '--bridges', type=str, default='rest,smtp,nxwitness',
+    help='Comma separated bridges to benchmark: rest, smtp, nxwitness')
+parser.add_argument(
+    '-r', '--rates', type=str, default='50,200',
+    help='Comma separated publish rates in messages per second, 0 publishes as fast as possible')
+parser.add_argument(
+    '-k', '--image_kb', type=str, default='0,100',
+    help='Comma separated event image sizes in KB, 0 leaves the image out')
+parser.add_argument(
+    '-d', '--duration', type=float, default=10,
+    help='Seconds to publish for in every scenario')
+parser.add_argument(
+    '--drain', type=float, default=30,
+    help='Seconds to wait for outstanding deliveries once publishing stopped')
+parser.add_argument(
+    '--topics', type=int, default=4,
+    help='Number of topics / devices the messages are spread over')
+parser.add_argument(
+    '-W', '--window', type=int, default=100,
+    help='Maximum number of messages queued by the publisher')
+parser.add_argument(
+    '-e', '--extra', type=str, default='',
+    help='Extra arguments passed to every bridge, eg: "--workers 8 --overflow drop-oldest"')
+parser.add_argument(
+    '-m', '--mqtt', type=str, default=None,
+    help='Use an external MQTT broker host:port (eg mosquitto) instead of the built-in one')
+parser.add_argument(
+    '-o', '--output', type=str, default=None,
+    help='Write the results as json to this file')
+parser.add_argument(
+    '-B', '--baseline', type=str, default=None,
+    help='Results json of an earlier run to compare against')
+parser.add_argument(
+    '--log', type=str, default=None,
+    help='Append the bridges output to this file instead of discarding it')
+
+args = parser.parse_args()
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+TOPIC_PREFIX = 'bench'
+
+def bridge_command(bridge, host, port, service_port):
+    topic = f'{TOPIC_PREFIX}/#'
+    if bridge == 'rest':
+        cmd = ['mqtt2rest.py', '-r', f'http://127.0.0.1:{service_port}/api/']
+    elif bridge == 'smtp':
+        cmd = ['mqtt2smtp.py', '-s', '127.0.0.1', '-i', str(service_port), '-w', 'bench']
+    else:
+        cmd = ['mqtt2nxwitness.py', '-a', 'bench', '-s', f'http://127.0.0.1:{service_port}']
+    return [sys.executable, os.path.join(TOOLS, cmd[0]), '-m', host, '-p', str(port), '-t', topic] + cmd[1:] + shlex.split(args.extra)
+
+def start_service(bridge, recorder):
+    if bridge == 'rest':
+        return bench_services.rest_server(recorder).start()
+    elif bridge == 'smtp':
+        return bench_services.smtp_server(recorder).start()
+    return bench_services.nxwitness_server(recorder).start()
+
+class RssSampler:
+    """Peak resident memory of a process, from /proc (linux only)."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='rss', daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:') or line.startswith('VmRSS:'):
+                        kb = int(line.split()[1])
+                        self.peak = kb if self.peak is None else max(self.peak, kb)
+        except (OSError, ValueError):
+            pass
+
+    def run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.sample()
+        self.running = False
+        return None if self.peak is None else round(self.peak / 1024, 1)
+
+def wait_subscribed(broker, timeout=15):
+    # the built-in broker knows when the bridge subscribed, an external one gets a fixed warmup
+    if broker is None:
+        time.sleep(3)
+        return True
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if len(broker.subscribers(f'{TOPIC_PREFIX}/0')) > 0:
+            return True
+        time.sleep(0.05)
+    return False
+
+def publish(client, recorder, rate, image_kb):
+    # the NX Witness stand-in matches bookmarks by the label
+    payloads = synthetic_payloads(image_kb, label='bench-{frame_id}')
+    interval = 1 / rate if rate > 0 else 0
+    started = time.monotonic()
+    n = 0
+    size = 0
+    # bounded in-flight publishes, at full speed the broker / bridge set the pace instead of paho's buffer
+    inflight = deque()
+    while time.monotonic() - started < args.duration:
+        delay = started + n * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        payload = str(n).encode().join(payloads[n % len(payloads)])
+        recorder.publish(n)
+        inflight.append(client.publish(f'{TOPIC_PREFIX}/{n % args.topics}', payload))
+        size += len(payload)
+        n += 1
+
+        while len(inflight) > args.window or (len(inflight) > 0 and inflight[0].is_published()):
+            inflight.popleft().wait_for_publish()
+    return n, size, time.monotonic() - started
+
+def run_scenario(bridge, rate, image_kb, broker, host, port, log):
+    recorder = bench_services.Recorder()
+    service = start_service(bridge, recorder)
+    cmd = bridge_command(bridge, host, port, service.port)
+    proc = subprocess.Popen(cmd, cwd=TOOLS, stdout=log, stderr=subprocess.STDOUT)
+    rss = RssSampler(proc.pid)
+
+    try:
+        if not wait_subscribed(broker) or proc.poll() is not None:
+            print(f'-- {bridge} failed to start: {" ".join(cmd)}')
+            return None
+
+        client = create_client(f'python-mqtt-bench-{os.getpid()}')[0]
+        client.connect(host, port)
+        client.loop_start()
+        published, size, elapsed = publish(client, recorder, rate, image_kb)
+
+        deadline = time.monotonic() + args.drain
+        while recorder.delivered() < published and time.monotonic() < deadline and proc.poll() is None:
+            time.sleep(0.05)
+
+        client.disconnect()
+        client.loop_stop()
+    finally:
+        peak = rss.stop()
+        proc.terminate()
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        service.shutdown()
+        service.server_close()
+
+    result = {
+        'bridge': bridge,
+        'rate': rate,
+        'image_kb': image_kb,
+        'published': published,
+        'publish_rate': round(published / elapsed, 1),
+        'payload_bytes': size // max(1, published),
+        'rss_mb': peak,
+    }
+    result.update(recorder.summary())
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=TOOLS, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def scenario_key(r):
+    return (r['bridge'], r['rate'], r['image_kb'])
+
+def compare(results, baseline):
+    # percent change against the baseline, positive is better for msgs/s, worse for latency and memory
+    previous = { scenario_key(r): r for r in baseline['results'] }
+    delta = lambda a, b: 'n/a' if a is None or not b else f'{(a - b) / b * 100:+.1f}%'
+    print(f"-- Compared to {baseline.get('commit')}:")
+    for r in results:
+        b = previous.get(scenario_key(r))
+        if b is None:
+            continue
+        print(f"   {r['bridge']:>10} {r['rate']:>6g} msg/s {r['image_kb']:>4} KB: msgs/s {delta(r['msgs_per_s'], b['msgs_per_s'])} "
+              f"p50 {delta(r['latency_ms']['p50'], b['latency_ms']['p50'])} p99 {delta(r['latency_ms']['p99'], b['latency_ms']['p99'])} "
+              f"rss {delta(r['rss_mb'], b['rss_mb'])}")
+
+def run():
+    broker = None
+    if args.mqtt is None:
+        broker = bench_services.Broker().start()
+        host, port = broker.host, broker.port
+    else:
+        host, port = args.mqtt.split(':') if ':' in args.mqtt else (args.mqtt, 1883)
+        port = int(port)
+
+    log = open(args.log, 'ab') if args.log else subprocess.DEVNULL
+    bridges = [b.strip() for b in args.bridges.split(',') if b.strip()]
+    for b in bridges:
+        if b not in ['rest', 'smtp', 'nxwitness']:
+            print(f'-- Unknown bridge: {b}')
+            sys.exit(1)
+
+    results = []
+    for bridge in bridges:
+        for image_kb in [int(k) for k in args.image_kb.split(',')]:
+            for rate in [float(r) for r in args.rates.split(',')]:
+                print(f'{datetime.now()} -- {bridge}: {rate:g} msg/s, {image_kb} KB images for {args.duration:g}s...')
+                r = run_scenario(bridge, rate, image_kb, broker, host, port, log)
+                if r is None:
+                    continue
+                results.append(r)
+                print(f"   delivered {r['delivered']}/{r['published']} {r['msgs_per_s']} msg/s "
+                      f"p50 {r['latency_ms']['p50']} ms p99 {r['latency_ms']['p99']} ms rss {r['rss_mb']} MB")
+
+    report = {
+        'commit': git_commit(),
+        'started': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'-- Results written to {args.output}')
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,236 @@
+import threading
+import time
+
+from collections import deque
+from datetime import datetime
+
+# overflow policies, selectable from the command line of every bridge
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+
+POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE]
+
+class DeliveryQueue:
+    """Bounded queue between the MQTT subscriber and the sink workers.
+
+    When the queue is full `put` applies the overflow policy:
+
+    - block: wait for a free slot, pushing back on the MQTT network loop
+    - drop-oldest: discard the oldest pending message to make room
+    - drop-newest: discard the incoming message
+    - coalesce: replace the pending message of the same topic with the
+      incoming one, if the topic has nothing pending wait like `block`
+
+    `on_discard` is called with every item dropped or replaced by the policy.
+    """
+
+    def __init__(self, maxsize=1000, policy=BLOCK, on_discard=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown overflow policy: {policy}')
+
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.on_discard = on_discard
+        self.items = deque()
+        self.by_topic = {}
+        self.unfinished = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        self.counters = {
+            'received': 0,
+            'delivered': 0,
+            'dropped_oldest': 0,
+            'dropped_newest': 0,
+            'coalesced': 0,
+        }
+
+    def put(self, topic, item, key=None):
+        # returns False if the incoming message was dropped, key is only used by ShardedQueue
+        with self.lock:
+            self.counters['received'] += 1
+
+            if self.policy == COALESCE:
+                entry = self.by_topic.get(topic)
+                if entry is not None:
+                    self._discard(entry[1])
+                    entry[1] = item
+                    self.counters['coalesced'] += 1
+                    return True
+
+            if len(self.items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.counters['dropped_newest'] += 1
+                    self._discard(item)
+                    return False
+                elif self.policy == DROP_OLDEST:
+                    entry = self.items.popleft()
+                    self._forget(entry)
+                    self._discard(entry[1])
+                    self.unfinished -= 1
+                    self.counters['dropped_oldest'] += 1
+                else:
+                    while len(self.items) >= self.maxsize:
+                        self.not_full.wait()
+
+            entry = [topic, item]
+            self.items.append(entry)
+            if self.policy == COALESCE:
+                self.by_topic[topic] = entry
+            self.unfinished += 1
+            self.not_empty.notify()
+            return True
+
+    def get(self, timeout=None):
+        # returns a (topic, item) tuple, raises TimeoutError if nothing arrived in time
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: len(self.items) > 0, timeout):
+                raise TimeoutError()
+
+            entry = self.items.popleft()
+            self._forget(entry)
+            self.not_full.notify()
+            return entry[0], entry[1]
+
+    def get_batch(self, size, linger=0):
+        # waits for a first message, then up to `linger` seconds for the batch to fill, returns a list of (topic, item)
+        with self.lock:
+            while True:
+                self.not_empty.wait_for(lambda: len(self.items) > 0)
+                if linger > 0 and len(self.items) < size:
+                    self.not_empty.wait_for(lambda: len(self.items) >= size, linger)
+                # another worker may have taken them meanwhile
+                if len(self.items) > 0:
+                    break
+
+            batch = []
+            while len(self.items) > 0 and len(batch) < size:
+                entry = self.items.popleft()
+                self._forget(entry)
+                batch.append((entry[0], entry[1]))
+            self.not_full.notify(len(batch))
+            return batch
+
+    def task_done(self, count=1):
+        with self.lock:
+            self.unfinished -= count
+            self.counters['delivered'] += count
+            if self.unfinished <= 0:
+                self.all_done.notify_all()
+
+    def join(self):
+        with self.lock:
+            self.all_done.wait_for(lambda: self.unfinished <= 0)
+
+    def qsize(self):
+        with self.lock:
+            return len(self.items)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.items)
+            return stats
+
+    def _discard(self, item):
+        if self.on_discard is not None:
+            self.on_discard(item)
+
+    def _forget(self, entry):
+        if self.by_topic.get(entry[0]) is entry:
+            del self.by_topic[entry[0]]
+
+class ShardedQueue:
+    """A DeliveryQueue per worker, messages with the same key always land on the same shard.
+
+    Keeps delivery ordered per key (eg per device) while different keys are
+    delivered concurrently. `maxsize` is split evenly between the shards.
+    """
+
+    def __init__(self, shards=1, maxsize=1000, policy=BLOCK, on_discard=None):
+        shards = max(1, shards)
+        self.shards = [DeliveryQueue(max(1, maxsize // shards), policy, on_discard) for i in range(shards)]
+
+    def put(self, topic, item, key=None):
+        key = topic if key is None else key
+        return self.shards[hash(key) % len(self.shards)].put(topic, item)
+
+    def join(self):
+        for shard in self.shards:
+            shard.join()
+
+    def qsize(self):
+        return sum(shard.qsize() for shard in self.shards)
+
+    def stats(self):
+        stats = {}
+        for shard in self.shards:
+            for k, v in shard.stats().items():
+                stats[k] = stats.get(k, 0) + v
+        return stats
+
+def add_arguments(parser, workers=1, short=False):
+    # shared command line options for the bridges, short flags only where the bridge has them free
+    flags = lambda s, l: [s, l] if short else [l]
+    parser.add_argument(
+        *flags('-w', '--workers'), type=int, default=workers,
+        help='Number of sink workers delivering queued messages')
+    parser.add_argument(
+        *flags('-q', '--queue_size'), type=int, default=1000,
+        help='Maximum number of messages waiting to be delivered')
+    parser.add_argument(
+        '--overflow', type=str, default=BLOCK, choices=POLICIES,
+        help='What to do when the queue is full: block the MQTT loop, drop the oldest / newest message or coalesce messages per topic')
+    parser.add_argument(
+        '--stats_interval', type=float, default=60,
+        help='Print queue counters every N seconds when messages were dropped or coalesced, 0 to disable')
+
+def start_workers(pending, target, count, name='worker', batch=1, linger=0):
+    # target is called with (topic, item) for every queued message, a ShardedQueue gets one worker per shard.
+    # with batch > 1 target is called with a list of up to `batch` (topic, item) tuples instead
+    if isinstance(pending, ShardedQueue):
+        for k, shard in enumerate(pending.shards):
+            start_workers(shard, target, 1, f'{name}-{k}', batch, linger)
+        return
+
+    def run_batches():
+        while True:
+            items = pending.get_batch(batch, linger)
+            try:
+                target(items)
+            except Exception as e:
+                print(f'{datetime.now()} -- {name} failed to deliver {len(items)} messages: {e}')
+            finally:
+                pending.task_done(len(items))
+
+    def run():
+        while True:
+            topic, item = pending.get()
+            try:
+                target(topic, item)
+            except Exception as e:
+                print(f'{datetime.now()} -- {name} failed to deliver message from `{topic}`: {e}')
+            finally:
+                pending.task_done()
+
+    for i in range(max(1, count)):
+        threading.Thread(target=run_batches if batch > 1 else run, name=f'{name}-{i}', daemon=True).start()
+
+def start_reporter(pending, interval, name='Queue'):
+    if interval <= 0:
+        return
+
+    def run():
+        last = pending.stats()
+        while True:
+            time.sleep(interval)
+            stats = pending.stats()
+            lost = sum(stats[k] - last[k] for k in ['dropped_oldest', 'dropped_newest', 'coalesced'])
+            if lost > 0:
+                print(f'{datetime.now()} -- {name}: ' + ' '.join(f'{k}: {v}' for k, v in stats.items()))
+            last = stats
+
+    threading.Thread(target=run, name=f'{name}-reporter', daemon=True).start()
@@ -0,0 +1,189 @@
+import sys
+import argparse
+import asyncio
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from rt_api import RtApi, ApiError, STATE_ERROR, STATE_RUNNING
+
+parser = argparse.ArgumentParser(description="Polls many CVEDIA-RT servers concurrently and reports / serves the aggregated instance states")
+parser.add_argument('-n', '--nodes', type=str, action='append', nargs='+', default=[], help='CVEDIA-RT REST API address(es), eg http://10.0.0.1:8080')
+parser.add_argument('-N', '--nodes_file', type=str, default=None, help='File with one REST API address per line')
+parser.add_argument('-t', '--timeout', type=float, default=5, help='Per node timeout in seconds')
+parser.add_argument('-g', '--get_state', default=False, action='store_true', help='Also fetch the state of every running instance')
+parser.add_argument('-j', '--json', default=False, action='store_true', help='Print the aggregated view as json')
+parser.add_argument('-S', '--serve', type=int, default=0, help='Keep polling and serve the aggregated view as json on this port, 0 polls once and exits')
+parser.add_argument('-i', '--interval', type=float, default=10, help='Seconds between polls when serving')
+parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Enable verbose mode')
+
+args = parser.parse_args()
+
+STATE_NAMES = {
+    STATE_ERROR: 'error',
+    STATE_RUNNING: 'running',
+}
+
+def state_name(state):
+    try:
+        return STATE_NAMES.get(int(state), str(state))
+    except (TypeError, ValueError):
+        return str(state)
+
+class Node:
+    """A CVEDIA-RT server and its last good snapshot."""
+
+    def __init__(self, api):
+        self.api = api
+        self.client = RtApi(api, 4, args.timeout, args.verbose)
+        # the requests helper blocks, every node gets its own threads so a slow node can't hold the others back
+        self.executor = ThreadPoolExecutor(4)
+        self.snapshot = None
+        self.error = None
+        self.polled_at = None
+
+    async def fetch(self, loop, uri, **kwargs):
+        return await loop.run_in_executor(self.executor, lambda: self.client.request(uri, 'GET', True, **kwargs))
+
+    async def poll(self, loop):
+        started = time.monotonic()
+        try:
+            version, instances = await asyncio.wait_for(asyncio.gather(
+                self.fetch(loop, '/api/version'),
+                self.fetch(loop, '/api/instance/get'),
+            ), args.timeout)
+            if not isinstance(instances, list) or not all(isinstance(r, dict) and 'instance_name' in r and 'solution' in r for r in instances):
+                raise ValueError('Unexpected /api/instance/get response, expected a list of instances with instance_name and solution')
+
+            if args.get_state:
+                running = [r for r in instances if state_name(r.get('state')) == 'running']
+                states = await asyncio.wait_for(asyncio.gather(*[
+                    self.fetch(loop, '/api/instance/get_state', params={ 'instance_name': r['instance_name'], 'solution': r['solution'] })
+                    for r in running
+                ], return_exceptions=True), max(0.1, args.timeout - (time.monotonic() - started)))
+                for r, state in zip(running, states):
+                    r['instance_state'] = None if isinstance(state, Exception) else state
+
+            self.snapshot = {
+                'version': version,
+                'instances': instances,
+                'fetched_at': datetime.now().isoformat(),
+                'latency_ms': round((time.monotonic() - started) * 1000, 1),
+            }
+            self.error = None
+        except asyncio.TimeoutError:
+            self.error = f'Timed out after {args.timeout}s'
+        except (ApiError, ValueError) as e:
+            self.error = str(e)
+        self.polled_at = datetime.now().isoformat()
+
+    def view(self):
+        # the last good snapshot is kept, stale once the latest poll failed
+        out = {
+            'api': self.api,
+            'ok': self.error is None and self.snapshot is not None,
+            'stale': self.error is not None and self.snapshot is not None,
+            'error': self.error,
+            'polled_at': self.polled_at,
+        }
+        if self.snapshot is not None:
+            out.update(self.snapshot)
+            out['states'] = {}
+            for r in self.snapshot['instances']:
+                name = state_name(r.get('state'))
+                out['states'][name] = out['states'].get(name, 0) + 1
+        return out
+
+def aggregate(nodes):
+    views = [node.view() for node in nodes]
+    states = {}
+    for v in views:
+        for name, count in v.get('states', {}).items():
+            states[name] = states.get(name, 0) + count
+
+    return {
+        'generated_at': datetime.now().isoformat(),
+        'nodes_total': len(views),
+        'nodes_ok': len([v for v in views if v['ok']]),
+        'nodes_stale': len([v for v in views if v['stale']]),
+        'nodes_down': len([v for v in views if not v['ok'] and not v['stale']]),
+        'instances': sum(len(v.get('instances', [])) for v in views),
+        'states': states,
+        'nodes': views,
+    }
+
+def print_view(view):
+    print(f"-- {view['nodes_ok']}/{view['nodes_total']} nodes ok, {view['nodes_stale']} stale, {view['nodes_down']} down, "
+          f"{view['instances']} instances: " + ', '.join(f'{k}: {v}' for k, v in sorted(view['states'].items())))
+    for v in view['nodes']:
+        status = 'ok' if v['ok'] else ('stale' if v['stale'] else 'down')
+        detail = ', '.join(f'{k}: {n}' for k, n in sorted(v.get('states', {}).items()))
+        version = json.dumps(v['version']) if 'version' in v else ''
+        latency = f"{v['latency_ms']:.0f} ms" if 'latency_ms' in v else '-'
+        print(f"   {v['api']:<32} {status:<6} {latency:>8}  {detail}  {version}  {v['error'] or ''}")
+
+async def poll_all(nodes, loop):
+    await asyncio.gather(*[node.poll(loop) for node in nodes])
+
+async def serve(nodes, loop):
+    view = { 'json': json.dumps(aggregate(nodes)).encode() }
+
+    async def handle(reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            body = view['json']
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n' +
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '0.0.0.0', args.serve)
+    print(f'-- Serving fleet status on http://0.0.0.0:{args.serve}/')
+    async with server:
+        while True:
+            started = time.monotonic()
+            await poll_all(nodes, loop)
+            view['json'] = json.dumps(aggregate(nodes)).encode()
+            if args.verbose:
+                print_view(aggregate(nodes))
+            await asyncio.sleep(max(0, args.interval - (time.monotonic() - started)))
+
+async def main():
+    apis = [a for al in args.nodes for a in al]
+    if args.nodes_file is not None:
+        with open(args.nodes_file) as f:
+            apis += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    if len(apis) == 0:
+        print('-- Must specify the nodes with -n or -N')
+        sys.exit(1)
+
+    nodes = [Node(api) for api in apis]
+    loop = asyncio.get_running_loop()
+
+    if args.serve > 0:
+        await serve(nodes, loop)
+        return
+
+    await poll_all(nodes, loop)
+    view = aggregate(nodes)
+    if args.json:
+        print(json.dumps(view, indent=4))
+    else:
+        print_view(view)
+
+    # shutting down waits for requests that outlived their node timeout
+    for node in nodes:
+        node.executor.shutdown(wait=False)
+    if view['nodes_ok'] < view['nodes_total']:
+        sys.exit(1)
+
+def run():
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,196 @@
+import os
+import sys
+import argparse
+import json
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlencode
+from rt_api import RtApi, ApiError
+
+import bench_services
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+parser = argparse.ArgumentParser(description="Pushes frames to the CVEDIA-RT /api/run onFrame endpoint from many connections and reports the achieved fps and latency")
+parser.add_argument('-a', '--api', type=str, default='http://127.0.0.1:8080', help='CVEDIA-RT REST API address')
+parser.add_argument('-s', '--solution', type=str, default='securt', help='Solution scope')
+parser.add_argument('-i', '--instances', type=str, default=None, help='Comma separated instance names, frames are spread over them round robin')
+parser.add_argument('-W', '--width', type=int, default=640, help='Frame width')
+parser.add_argument('-H', '--height', type=int, default=360, help='Frame height')
+parser.add_argument('-f', '--frames', type=str, default=None,
+                    help='Directory of images (requires Pillow) or .raw BGR frames, resized / checked once before pushing. Random frames are used when not set')
+parser.add_argument('-p', '--pool', type=int, default=16, help='Number of random frames to generate')
+parser.add_argument('-c', '--connections', type=int, default=8, help='Number of concurrent connections')
+parser.add_argument('-r', '--rate', type=float, default=0, help='Target frames per second over all instances, 0 pushes as fast as possible')
+parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds to push frames for')
+parser.add_argument('-o', '--output', type=str, default=None, help='Write the results as json')
+parser.add_argument('-L', '--local', default=False, action='store_true', help='Push to a local stand-in server instead of --api')
+parser.add_argument('--local_ms', type=float, default=5, help='Milliseconds the local stand-in server takes per frame')
+parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Enable verbose mode')
+
+args = parser.parse_args()
+
+def load_frames():
+    # raw BGR frames, width * height * 3 bytes each
+    size = args.width * args.height * 3
+    if args.frames is None:
+        return [os.urandom(size) for k in range(max(1, args.pool))]
+
+    frames = []
+    for fn in sorted(os.listdir(args.frames)):
+        path = os.path.join(args.frames, fn)
+        if fn.endswith('.raw'):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) != size:
+                print(f'-- Skipping {fn}: {len(data)} bytes, expected {size} for {args.width}x{args.height}')
+                continue
+            frames.append(data)
+        elif fn.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')):
+            if Image is None:
+                print('-- Images require Pillow: python3 -m pip install pillow')
+                sys.exit(1)
+            with Image.open(path) as image:
+                frames.append(image.convert('RGB').resize((args.width, args.height)).tobytes('raw', 'BGR'))
+    return frames
+
+class Stats:
+    """Per instance latencies and response codes."""
+
+    def __init__(self, instances):
+        self.lock = threading.Lock()
+        self.latencies = { i: [] for i in instances }
+        self.codes = { i: Counter() for i in instances }
+
+    def record(self, instance, code, latency):
+        with self.lock:
+            self.codes[instance][code] += 1
+            if code == 200:
+                self.latencies[instance].append(latency)
+
+    def summary(self, instance, elapsed):
+        latencies = sorted(self.latencies[instance])
+        codes = self.codes[instance]
+        sent = sum(codes.values())
+        ms = lambda p: None if len(latencies) == 0 else round(bench_services.percentile(latencies, p) * 1000, 2)
+        return {
+            'sent': sent,
+            'ok': len(latencies),
+            'error_rate': round((sent - len(latencies)) / sent, 4) if sent > 0 else None,
+            'codes': { str(k): v for k, v in codes.items() },
+            'fps': round(len(latencies) / elapsed, 1),
+            'latency_ms': { 'p50': ms(50), 'p90': ms(90), 'p99': ms(99), 'max': ms(100) },
+        }
+
+class Pusher:
+    """Connections share one schedule, frame n is due at start + n / rate."""
+
+    def __init__(self, api, instances, frames):
+        self.api = api
+        self.frames = frames
+        self.stats = Stats(instances)
+        self.lock = threading.Lock()
+        self.next = 0
+        # the query strings are built once per instance
+        self.uris = [(i, '/api/run?' + urlencode({
+            'solution': args.solution,
+            'instance_name': i,
+            'function': 'onFrame',
+            'width': args.width,
+            'height': args.height,
+        })) for i in instances]
+
+    def take(self):
+        with self.lock:
+            n = self.next
+            self.next += 1
+        return n
+
+    def worker(self, started, deadline):
+        headers = { 'Content-Type': 'application/octet-stream' }
+        while True:
+            n = self.take()
+            if args.rate > 0:
+                due = started + n / args.rate
+                if due >= deadline:
+                    return
+                if due > time.monotonic():
+                    time.sleep(due - time.monotonic())
+            elif time.monotonic() >= deadline:
+                return
+
+            instance, uri = self.uris[n % len(self.uris)]
+            sent = time.monotonic()
+            try:
+                r = self.api.request(uri, 'POST', False, data=self.frames[n % len(self.frames)], headers=headers)
+                code = r.status_code
+                if args.verbose and code != 200:
+                    print(f'-- {instance}: {code} {r.text}')
+            except ApiError as e:
+                code = 'error'
+                if args.verbose:
+                    print(f'-- {instance}: {e}')
+            self.stats.record(instance, code, time.monotonic() - sent)
+
+    def run(self):
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=self.worker, args=(started, deadline), daemon=True) for k in range(max(1, args.connections))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.monotonic() - started
+
+def run():
+    frames = load_frames()
+    if len(frames) == 0:
+        print(f'-- No frames found in {args.frames}')
+        sys.exit(1)
+
+    server = None
+    api = args.api
+    if args.local:
+        server = bench_services.frame_server(args.local_ms / 1000).start()
+        api = f'http://127.0.0.1:{server.port}'
+
+    instances = [i.strip() for i in (args.instances or 'Object Intrusion').split(',') if i.strip()]
+    print(f'-- Pushing {len(frames)} {args.width}x{args.height} frames to {len(instances)} instance(s) at {api} '
+          f'over {args.connections} connections, {f"{args.rate:g} fps" if args.rate > 0 else "as fast as possible"} for {args.duration:g}s...')
+
+    pusher = Pusher(RtApi(api, max(1, args.connections)), instances, frames)
+    elapsed = pusher.run()
+
+    results = { i: pusher.stats.summary(i, elapsed) for i in instances }
+    total_fps = 0
+    for i, r in results.items():
+        total_fps += r['fps']
+        print(f"   {i}: {r['fps']} fps, {r['ok']}/{r['sent']} ok, latency p50 {r['latency_ms']['p50']} ms "
+              f"p90 {r['latency_ms']['p90']} ms p99 {r['latency_ms']['p99']} ms max {r['latency_ms']['max']} ms"
+              + (f", codes: {json.dumps(r['codes'])}" if r['ok'] < r['sent'] else ''))
+    print(f'-- {total_fps:.1f} fps in total' + (f', {total_fps / args.rate * 100:.0f}% of the target' if args.rate > 0 else ''))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.now().isoformat(),
+                'api': 'local' if args.local else api,
+                'width': args.width,
+                'height': args.height,
+                'connections': args.connections,
+                'rate': args.rate,
+                'duration': args.duration,
+                'instances': results,
+            }, f, indent=4)
+
+    if server is not None:
+        server.shutdown()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,195 @@
+import os
+import io
+import base64
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+EXTENSIONS = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+]
+
+def extension(image):
+    for magic, ext in EXTENSIONS:
+        if image.startswith(magic):
+            return ext
+    return '.bin'
+
+class FrameStore:
+    """Content-addressed image store, files are named after the sha256 of the original image.
+
+    Duplicate frames are stored once. The least recently stored frames are
+    evicted once the store holds more than `max_bytes` or `max_files` (0
+    disables either). With `max_side` or `quality` set images are downscaled
+    and re-encoded to jpeg, requires Pillow.
+    """
+
+    def __init__(self, path, max_bytes=0, max_files=0, url=None, max_side=0, quality=0):
+        if (max_side > 0 or quality > 0) and Image is None:
+            raise RuntimeError('Downscaling / re-encoding frames requires Pillow: python3 -m pip install pillow')
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        # references point to url/<file> when set, to the local file otherwise
+        self.url = url.rstrip('/') if url else None
+        self.max_side = max_side
+        self.quality = quality
+        self.lock = threading.Lock()
+        # digest -> (file name, size), oldest first
+        self.index = OrderedDict()
+        self.bytes = 0
+        self.counters = {
+            'stored': 0,
+            'duplicates': 0,
+            'evicted': 0,
+        }
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def put(self, image):
+        # stores the image bytes and returns a reference
+        digest = hashlib.sha256(image).hexdigest()
+        with self.lock:
+            entry = self.index.get(digest)
+            if entry is not None:
+                self.index.move_to_end(digest)
+                self.counters['duplicates'] += 1
+                # keeps the eviction order across restarts
+                try:
+                    os.utime(os.path.join(self.path, entry[0]))
+                except OSError:
+                    pass
+                return self.reference(digest, *entry)
+
+        if self.max_side > 0 or self.quality > 0:
+            image = self.reencode(image)
+
+        fn = os.path.join(digest[:2], digest + extension(image))
+        full = os.path.join(self.path, fn)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f'{full}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(image)
+        os.replace(tmp, full)
+
+        with self.lock:
+            if digest not in self.index:
+                self.index[digest] = (fn, len(image))
+                self.bytes += len(image)
+                self.counters['stored'] += 1
+                self._evict()
+            return self.reference(digest, fn, len(image))
+
+    def reencode(self, image):
+        with Image.open(io.BytesIO(image)) as im:
+            if self.max_side > 0:
+                im.thumbnail((self.max_side, self.max_side))
+            out = io.BytesIO()
+            im.convert('RGB').save(out, 'JPEG', quality=self.quality or 85)
+            return out.getvalue()
+
+    def reference(self, digest, fn, size):
+        location = f'{self.url}/{fn}' if self.url else os.path.join(self.path, fn)
+        return { 'sha256': digest, 'url': location, 'bytes': size }
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['files'] = len(self.index)
+            stats['bytes'] = self.bytes
+            return stats
+
+    def _load(self):
+        # rebuilds the index from disk, oldest modification first
+        files = []
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                full = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    os.remove(full)
+                    continue
+                st = os.stat(full)
+                files.append((st.st_mtime, os.path.relpath(full, self.path), st.st_size))
+
+        for mtime, fn, size in sorted(files):
+            self.index[os.path.basename(fn).split('.')[0]] = (fn, size)
+            self.bytes += size
+        self._evict()
+
+    def _evict(self):
+        while len(self.index) > 0 and ((self.max_bytes > 0 and self.bytes > self.max_bytes) or
+                                       (self.max_files > 0 and len(self.index) > self.max_files)):
+            digest, (fn, size) = self.index.popitem(last=False)
+            self.bytes -= size
+            self.counters['evicted'] += 1
+            try:
+                os.remove(os.path.join(self.path, fn))
+            except FileNotFoundError:
+                pass
+
+stores = {}
+stores_lock = threading.Lock()
+
+def open_store(path, **kwargs):
+    # sinks sharing a directory share the store, its index would diverge otherwise
+    with stores_lock:
+        if path not in stores:
+            stores[path] = FrameStore(path, **kwargs)
+        return stores[path]
+
+def create_store(frame_store=None, frame_store_mb=1024, frame_url=None, frame_max_side=0, frame_quality=0):
+    # builds the store from the sink options, None when offloading is disabled
+    if frame_store is None:
+        return None
+    return open_store(frame_store, max_bytes=frame_store_mb * 1024 * 1024, url=frame_url, max_side=frame_max_side, quality=frame_quality)
+
+def offload(store, data, field='image'):
+    """Moves the base64 image of a message to the store.
+
+    Returns a copy of the message with `field` replaced by `<field>_ref`, the
+    message is returned as is when it has no image.
+    """
+
+    if not isinstance(data, dict) or data.get(field) is None:
+        return data
+
+    data = dict(data)
+    data[f'{field}_ref'] = store.put(base64.b64decode(data.pop(field)))
+    return data
+
+def add_arguments(parser):
+    # shared command line options of the bridges forwarding images
+    parser.add_argument(
+        '--frame_store', type=str, default=None,
+        help='Directory images are offloaded to, messages carry a reference instead of the image, disabled if not set')
+    parser.add_argument(
+        '--frame_store_mb', type=int, default=1024,
+        help='Maximum frame store size in MB, least recently stored frames are evicted, 0 for unlimited')
+    parser.add_argument(
+        '--frame_url', type=str, default=None,
+        help='Base url the frame store is served from, references are local paths if not set')
+    parser.add_argument(
+        '--frame_max_side', type=int, default=0,
+        help='Downscale stored frames to at most N pixels wide / high, requires Pillow, 0 to keep the original size')
+    parser.add_argument(
+        '--frame_quality', type=int, default=0,
+        help='Re-encode stored frames as jpeg with this quality, requires Pillow, 0 to keep the original encoding')
+
+def options(args):
+    # sink keyword arguments from the add_arguments options
+    return {
+        'frame_store': args.frame_store,
+        'frame_store_mb': args.frame_store_mb,
+        'frame_url': args.frame_url,
+        'frame_max_side': args.frame_max_side,
+        'frame_quality': args.frame_quality,
+    }
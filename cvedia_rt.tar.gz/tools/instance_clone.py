@@ -1,19 +1,27 @@
 import os
 import sys
 import argparse
+import csv
 import json
 import random
 import base64
-import requests
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from rt_api import RtApi, ApiError, StatePoller, STATE_ERROR, STATE_RUNNING, find_instance
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 parser = argparse.ArgumentParser(description="Clones an existing instance with customizable inputs / outputs")
 
 # cvedia-rt
 parser.add_argument('-a', '--api', type=str, default='http://127.0.0.1:8080', help='CVEDIA-RT REST API address')
-parser.add_argument('-s', '--solution', type=str, required=True, help='Solution scope')
-parser.add_argument('-b', '--base_instance', type=str, required=True, help='Base instance')
-parser.add_argument('-n', '--new_instance', type=str, required=True, help='New instance name')
+parser.add_argument('-s', '--solution', type=str, default=None, help='Solution scope')
+parser.add_argument('-b', '--base_instance', type=str, default=None, help='Base instance')
+parser.add_argument('-n', '--new_instance', type=str, default=None, help='New instance name')
 parser.add_argument('-i', '--input', type=str, default=None, help='New instance input uri')
 parser.add_argument('-o', '--output', type=str, default=None, help='New instance output uri')
 parser.add_argument('-K', '--sink', type=str, default=None, help='New instance output sink name')
@@ -21,170 +29,247 @@ parser.add_argument('-S', '--start', default=False, action='store_true', help='S
 parser.add_argument('-H', '--handler', type=str, default='Output', help='Output handler name within the new instance')
 parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Enable verbose mode')
 
+# bulk
+parser.add_argument('-f', '--manifest', type=str, default=None,
+                    help='CSV or YAML (requires pyyaml) manifest of instances to clone with columns: name, base_instance, input, output, sink and optionally solution, handler, start. Missing values default to the command line options')
+parser.add_argument('-w', '--workers', type=int, default=8, help='Number of instances cloned / configured concurrently')
+parser.add_argument('-B', '--batch', type=int, default=50, help='Number of instances added before reloading the solution')
+
 args = parser.parse_args()
 
+api = RtApi(args.api, max(1, args.workers) + 1, verbose=args.verbose)
+poller = StatePoller(api)
+
+class CloneError(Exception):
+    pass
+
 def req(uri, method, check, **kwargs):
-    url = f'{args.api}{uri}'
-    response = requests.request(
-        method,
-        url,
-        verify=False,
-        **kwargs
-    )
-    
-    if check == False:
-        return response
-    
-    if response.status_code > 299:
-        print(f'Error code: {response.status_code} response: {response.text}')
-        sys.exit(1)
-    
-    output = response.json()
-    
-    if args.verbose:
-        print(f'-- API Request to: {url} response: {json.dumps(output)}')
-        
-    return output
-
-def check_instance(solution, instance):
-    res = req('/api/instance/get', 'GET', True)
-    check = False
-    for r in res:
+    try:
+        return api.request(uri, method, check, **kwargs)
+    except ApiError as e:
+        raise CloneError(str(e))
+
+def check_instance_to(solution, instance, mode, timeout = 30):
+    # waits on the shared poller, a single listing per tick serves every instance in flight
+    def ready(r):
+        if r is None:
+            return False
+        if mode == 'exists':
+            return True
         try:
-            if r['instance_name'] == args.base_instance and r['solution'] == args.solution:
-                check = True
-                break
-        except:
-            pass
-    
-    return check    
-
-def check_instance_to(solution, instance, mode, retries = 30):
-    check = False
-    while retries > 0:
-        res = req('/api/instance/get', 'GET', False)
-        if res.status_code <= 299:
-            data = res.json()
-            
-            for r in data:
-                try:
-                    if r['instance_name'] == instance and r['solution'] == solution:
-                        if mode == 'exists':
-                            check = True
-                            break
-                        elif mode == 'running':
-                            if int(r['state']) == 4:
-                                check = True
-                                break
-                            elif int(r['state']) == 2:
-                                print('-- Instance started but is in error state, please check CVEDIA-RT logs.')
-                                sys.exit(1)
-                except:
-                    pass
-        
-        if check:
-            break
-        
-        retries -= 1
-        time.sleep(1)
-    
-    return check
+            return int(r['state']) in [STATE_RUNNING, STATE_ERROR]
+        except (KeyError, TypeError, ValueError):
+            return False
 
-def run():
-    print('-- Checking if base instance exists...')
-    
-    if not check_instance(args.solution, args.base_instance):
-        print(f'-- Unable to find instance: {args.base_instance} in solution: {args.solution}')
-        sys.exit(1)
-    
-    print('-- Cloning base instance...')
+    try:
+        r = poller.wait(solution, instance, ready, timeout)
+    except TimeoutError:
+        return False
+
+    if mode == 'running' and int(r['state']) == STATE_ERROR:
+        raise CloneError('Instance started but is in error state, please check CVEDIA-RT logs.')
+    return True
+
+def wait_created(jobs, timeout = 30):
+    # waits for the whole batch at once, returns the jobs still missing once the timeout expired
+    missing = lambda index: [job for job in jobs if (job['solution'], job['name']) not in index]
+    try:
+        poller.wait_index(lambda index: len(missing(index)) == 0, timeout)
+        return []
+    except TimeoutError:
+        return missing(poller.index)
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ['1', 'true', 'yes', 'y']
+
+def make_job(row):
+    # manifest row / command line to clone job, blank values fall back to the command line options
+    row = { k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k is not None }
+    value = lambda k, default: default if row.get(k) in [None, ''] else row[k]
+    job = {
+        'name': value('name', None),
+        'base_instance': value('base_instance', args.base_instance),
+        'solution': value('solution', args.solution),
+        'input': value('input', args.input),
+        'output': value('output', args.output),
+        'sink': value('sink', args.sink),
+        'handler': value('handler', args.handler),
+        'start': to_bool(value('start', args.start)),
+    }
+
+    for k in ['name', 'base_instance', 'solution']:
+        if job[k] is None:
+            raise ValueError(f'Missing {k} for instance: {job["name"]}')
+    return job
+
+def load_manifest(fn):
+    with open(fn, newline='') as f:
+        if fn.endswith('.yaml') or fn.endswith('.yml'):
+            if yaml is None:
+                print('-- yaml manifests require pyyaml: python3 -m pip install pyyaml')
+                sys.exit(1)
+            rows = yaml.safe_load(f) or []
+            if isinstance(rows, dict):
+                rows = rows.get('instances', [])
+        else:
+            rows = list(csv.DictReader(f))
+
+    return [make_job(row) for row in rows]
+
+def log(job, message):
+    print(f'-- {job["prefix"]}{message}')
+
+def add_instance(job):
+    log(job, 'Cloning base instance...')
     req('/api/instance/add', 'POST', True, json={
-        "instance_name": args.new_instance,
-        "base_on_instance": args.base_instance,
-        "solution": args.solution
+        "instance_name": job['name'],
+        "base_on_instance": job['base_instance'],
+        "solution": job['solution']
     })
-    
-    time.sleep(1)
-    req('/api/solution/reload', 'GET', False)
-    
-    if not check_instance_to(args.solution, args.new_instance, 'exists'):
-        print('-- Timed out waiting for new instance to be created')
-        sys.exit(1)
-    
-    if args.input is not None or args.output is not None or args.sink is not None:
-        print('-- Starting new instance...')
-        req('/api/instance/start', 'POST', True, json={
-            "instance_name": args.new_instance,
-            "solution": args.solution
-        })
-        
-        print('-- Waiting for instance to start...')
-        if not check_instance_to(args.solution, args.new_instance, 'running', 120):
-            print('-- Timed out waiting for new instance to be started')
-            sys.exit(1)
-        
-        if args.input is not None:
-            print('-- Configuring input...')
-            req('/api/instance/set_state', 'POST', True, json={
-                "instance_name": args.new_instance,
-                "solution": args.solution,
+
+def configure_instance(job):
+    instance = {
+        "instance_name": job['name'],
+        "solution": job['solution']
+    }
+
+    if job['input'] is not None or job['output'] is not None or job['sink'] is not None:
+        log(job, 'Starting new instance...')
+        req('/api/instance/start', 'POST', True, json=instance)
+
+        log(job, 'Waiting for instance to start...')
+        if not check_instance_to(job['solution'], job['name'], 'running', 120):
+            raise CloneError('Timed out waiting for new instance to be started')
+
+        if job['input'] is not None:
+            log(job, 'Configuring input...')
+            req('/api/instance/set_state', 'POST', True, json=dict(instance, **{
                 "path": "Input/uri",
-                "value": args.input
-            })
-        
-        if args.output is not None:
-            print('-- Configuring output...')
-            req('/api/instance/set_state', 'POST', True, json={
-                "instance_name": args.new_instance,
-                "solution": args.solution,
+                "value": job['input']
+            }))
+
+        if job['output'] is not None:
+            log(job, 'Configuring output...')
+            req('/api/instance/set_state', 'POST', True, json=dict(instance, **{
                 "path": "Output/handlers",
                 "value": {
-                    f"{args.handler}": {
+                    f"{job['handler']}": {
                         "enabled": True,
-                        "uri": args.output
+                        "uri": job['output']
                     }
                 }
-            })
-        
-        if args.sink is not None:
-            print('-- Configuring output sink...')
-            req('/api/instance/set_state', 'POST', True, json={
-                "instance_name": args.new_instance,
-                "solution": args.solution,
-                "path": f"Output/handlers/{args.handler}/sink",
-                "value": args.sink
-            })
-    
-        print('-- Saving...')
-        req('/api/instance/save_state', 'POST', True, json={
-            "instance_name": args.new_instance,
-            "solution": args.solution
-        })
-        
-        print('-- Stopping new instance...')
-        req('/api/instance/stop', 'POST', True, json={
-            "instance_name": args.new_instance,
-            "solution": args.solution
-        })
-    
-    if args.start:
-        print('-- Starting new instance...')
-        req('/api/instance/start', 'POST', True, json={
-            "instance_name": args.new_instance,
-            "solution": args.solution
-        })
-        
-        print('-- Waiting for instance to start...')
-        if not check_instance_to(args.solution, args.new_instance, 'running', 120):
-            print('-- Timed out waiting for new instance to be started')
+            }))
+
+        if job['sink'] is not None:
+            log(job, 'Configuring output sink...')
+            req('/api/instance/set_state', 'POST', True, json=dict(instance, **{
+                "path": f"Output/handlers/{job['handler']}/sink",
+                "value": job['sink']
+            }))
+
+        log(job, 'Saving...')
+        req('/api/instance/save_state', 'POST', True, json=instance)
+
+        log(job, 'Stopping new instance...')
+        req('/api/instance/stop', 'POST', True, json=instance)
+
+    if job['start']:
+        log(job, 'Starting new instance...')
+        req('/api/instance/start', 'POST', True, json=instance)
+
+        log(job, 'Waiting for instance to start...')
+        if not check_instance_to(job['solution'], job['name'], 'running', 120):
+            raise CloneError('Timed out waiting for new instance to be started')
+
+        log(job, 'Final running instance state: ' + json.dumps(req('/api/instance/get_state', 'GET', True, params=instance)))
+
+    log(job, f'Completed, created new instance: {job["name"]} from: {job["base_instance"]} in solution: {job["solution"]}')
+
+def attempt(pool, fn, jobs, failed):
+    # runs fn for every job on the pool, failed jobs are recorded and left out of the result
+    def run_job(job):
+        try:
+            fn(job)
+            return True
+        except CloneError as e:
+            log(job, str(e))
+            failed[job['name']] = str(e)
+            return False
+
+    return [job for job, ok in zip(jobs, pool.map(run_job, jobs)) if ok]
+
+def run_batch(pool, jobs, failed):
+    jobs = attempt(pool, add_instance, jobs, failed)
+    if len(jobs) == 0:
+        return
+
+    # one reload for the whole batch
+    req('/api/solution/reload', 'GET', False)
+
+    for job in wait_created(jobs):
+        log(job, 'Timed out waiting for new instance to be created')
+        failed[job['name']] = 'Timed out waiting for new instance to be created'
+
+    attempt(pool, configure_instance, [job for job in jobs if job['name'] not in failed], failed)
+
+def run():
+    try:
+        if args.manifest is not None:
+            jobs = load_manifest(args.manifest)
+        elif args.new_instance is not None:
+            jobs = [make_job({ 'name': args.new_instance })]
+        else:
+            print('-- Must specify a new instance with -n or a manifest with -f')
             sys.exit(1)
-        
-        print('-- Final running instance state:', json.dumps(req('/api/instance/get_state', 'GET', True, params={
-            "instance_name": args.new_instance,
-            "solution": args.solution
-        })))
-    
-    print(f'-- Completed, created new instance: {args.new_instance} from: {args.base_instance} in solution: {args.solution}')
+    except ValueError as e:
+        print(f'-- {e}')
+        sys.exit(1)
+
+    for job in jobs:
+        job['prefix'] = f'[{job["name"]}] ' if len(jobs) > 1 else ''
+
+    try:
+        print('-- Checking if base instance exists...')
+        instances = req('/api/instance/get', 'GET', True)
+    except CloneError as e:
+        print(e)
+        sys.exit(1)
+
+    failed = {}
+    pending = []
+    skipped = 0
+    for job in jobs:
+        if find_instance(instances, job['solution'], job['base_instance']) is None:
+            log(job, f'Unable to find instance: {job["base_instance"]} in solution: {job["solution"]}')
+            failed[job['name']] = 'base instance not found'
+        elif len(jobs) > 1 and find_instance(instances, job['solution'], job['name']) is not None:
+            # lets an interrupted manifest be re-run
+            log(job, 'Instance already exists, skipping')
+            skipped += 1
+        else:
+            pending.append(job)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max(1, args.workers)) as pool:
+        batch = max(1, args.batch)
+        for k in range(0, len(pending), batch):
+            try:
+                run_batch(pool, pending[k:k + batch], failed)
+            except CloneError as e:
+                print(f'-- {e}')
+                sys.exit(1)
+
+    if len(jobs) > 1:
+        if args.verbose:
+            print(f'-- {poller.fetches} instance listings fetched')
+        print(f'-- Completed {len(pending) - len([j for j in pending if j["name"] in failed])}/{len(jobs)} instances in {time.monotonic() - started:.1f}s, {skipped} skipped, {len(failed)} failed')
+        for name, error in failed.items():
+            print(f'   {name}: {error}')
+
+    if len(failed) > 0:
+        sys.exit(1)
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,233 @@
+import sys
+import argparse
+import csv
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from rt_api import RtApi, ApiError, StatePoller, STATE_ERROR, STATE_RUNNING, find_instance
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+parser = argparse.ArgumentParser(description="Applies a desired state to many instances, only the paths that differ are changed")
+
+# cvedia-rt
+parser.add_argument('-a', '--api', type=str, default='http://127.0.0.1:8080', help='CVEDIA-RT REST API address')
+parser.add_argument('-s', '--solution', type=str, default=None, help='Default solution scope for instances without one')
+parser.add_argument('-f', '--desired', type=str, required=True,
+                    help='Desired state: yaml (requires pyyaml) / json list of { solution, instance_name, state } where state maps paths, eg Input/uri, or nested objects to values. A CSV with the instance_clone.py manifest columns is accepted too')
+parser.add_argument('-H', '--handler', type=str, default='Output', help='Output handler name used for the CSV output / sink columns')
+parser.add_argument('-w', '--workers', type=int, default=8, help='Number of instances reconciled concurrently')
+parser.add_argument('-d', '--dry_run', default=False, action='store_true', help='Only print the differences')
+parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Enable verbose mode')
+
+args = parser.parse_args()
+
+api = RtApi(args.api, max(1, args.workers) + 1, verbose=args.verbose)
+poller = StatePoller(api)
+
+MISSING = object()
+
+def flatten(state, prefix=''):
+    # nested objects to path -> value, leaves are compared and set one by one
+    out = {}
+    for k, v in state.items():
+        path = f'{prefix}/{k}' if prefix != '' else str(k)
+        if isinstance(v, dict) and len(v) > 0:
+            out.update(flatten(v, path))
+        else:
+            out[path] = v
+    return out
+
+def get_path(state, path):
+    for key in path.split('/'):
+        if not isinstance(state, dict) or key not in state:
+            return MISSING
+        state = state[key]
+    return state
+
+def diff(current, desired):
+    # [(path, current value, desired value)] of the paths that differ
+    changes = []
+    for path, value in desired.items():
+        old = get_path(current, path)
+        if old is MISSING or old != value:
+            changes.append((path, None if old is MISSING else old, value))
+    return changes
+
+def csv_state(row):
+    # instance_clone.py manifest columns to paths
+    handler = row.get('handler') or args.handler
+    state = {}
+    if row.get('input'):
+        state['Input/uri'] = row['input']
+    if row.get('output'):
+        state[f'Output/handlers/{handler}/enabled'] = True
+        state[f'Output/handlers/{handler}/uri'] = row['output']
+    if row.get('sink'):
+        state[f'Output/handlers/{handler}/sink'] = row['sink']
+    return state
+
+def load_desired(fn):
+    with open(fn, newline='') as f:
+        if fn.endswith('.csv'):
+            rows = []
+            for row in csv.DictReader(f):
+                row = { k.strip(): (v or '').strip() for k, v in row.items() if k is not None }
+                rows.append({ 'solution': row.get('solution'), 'instance_name': row.get('name'), 'state': csv_state(row) })
+        elif fn.endswith('.yaml') or fn.endswith('.yml'):
+            if yaml is None:
+                print('-- yaml files require pyyaml: python3 -m pip install pyyaml')
+                sys.exit(1)
+            rows = yaml.safe_load(f) or []
+        else:
+            rows = json.load(f)
+
+    if isinstance(rows, dict):
+        rows = rows.get('instances', [])
+
+    targets = []
+    for row in rows:
+        target = {
+            'solution': row.get('solution') or args.solution,
+            'name': row.get('instance_name') or row.get('name'),
+            'state': flatten(row.get('state') or {}),
+        }
+        if target['solution'] is None or target['name'] is None:
+            raise ValueError(f'Missing solution or instance name in: {json.dumps(row)}')
+        target['prefix'] = f'[{target["solution"]}/{target["name"]}] '
+        targets.append(target)
+    return targets
+
+def log(target, message):
+    print(f'-- {target["prefix"]}{message}')
+
+def get_state(target):
+    return api.request('/api/instance/get_state', 'GET', True, params={
+        "instance_name": target['name'],
+        "solution": target['solution']
+    })
+
+def wait_running(target, timeout=120):
+    def ready(r):
+        try:
+            return r is not None and int(r['state']) in [STATE_RUNNING, STATE_ERROR]
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    try:
+        r = poller.wait(target['solution'], target['name'], ready, timeout)
+    except TimeoutError:
+        raise ApiError('Timed out waiting for instance to be started')
+    if int(r['state']) == STATE_ERROR:
+        raise ApiError('Instance started but is in error state, please check CVEDIA-RT logs.')
+
+# reconcile result of stopped instances under --dry_run
+UNKNOWN = 'unknown'
+
+def reconcile(target, running):
+    # returns the number of paths changed
+    instance = {
+        "instance_name": target['name'],
+        "solution": target['solution']
+    }
+
+    started = False
+    try:
+        current = get_state(target)
+    except ApiError:
+        if running:
+            raise
+        current = None
+
+    try:
+        if current is None:
+            if args.dry_run:
+                # reading it would mean starting the instance
+                log(target, 'State unknown, instance is stopped')
+                return UNKNOWN
+
+            # the state of a stopped instance may only be readable once it runs
+            log(target, 'Starting instance to read its state...')
+            api.request('/api/instance/start', 'POST', True, json=instance)
+            started = True
+            wait_running(target)
+            current = get_state(target)
+
+        changes = diff(current, target['state'])
+        if len(changes) == 0:
+            log(target, 'Up to date')
+            return 0
+
+        for path, old, new in changes:
+            log(target, f'{path}: {json.dumps(old)} -> {json.dumps(new)}')
+        if args.dry_run:
+            return len(changes)
+
+        if not running and not started:
+            api.request('/api/instance/start', 'POST', True, json=instance)
+            started = True
+            wait_running(target)
+
+        for path, old, new in changes:
+            api.request('/api/instance/set_state', 'POST', True, json=dict(instance, path=path, value=new))
+
+        api.request('/api/instance/save_state', 'POST', True, json=instance)
+        log(target, f'Applied {len(changes)} change(s)')
+        return len(changes)
+    finally:
+        # leave stopped instances stopped
+        if started:
+            api.request('/api/instance/stop', 'POST', True, json=instance)
+
+def run():
+    try:
+        targets = load_desired(args.desired)
+    except (ValueError, OSError) as e:
+        print(f'-- {e}')
+        sys.exit(1)
+
+    try:
+        instances = api.instances()
+    except ApiError as e:
+        print(f'-- {e}')
+        sys.exit(1)
+
+    results = {}
+
+    def run_target(target):
+        r = find_instance(instances, target['solution'], target['name'])
+        if r is None:
+            log(target, 'Instance not found')
+            results[target['prefix']] = None
+            return
+        try:
+            running = int(r.get('state', -1)) == STATE_RUNNING
+        except (TypeError, ValueError):
+            running = False
+
+        try:
+            results[target['prefix']] = reconcile(target, running)
+        except ApiError as e:
+            log(target, str(e))
+            results[target['prefix']] = None
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max(1, args.workers)) as pool:
+        list(pool.map(run_target, targets))
+
+    changed = len([v for v in results.values() if v not in (None, UNKNOWN) and v > 0])
+    failed = len([v for v in results.values() if v is None])
+    unknown = len([v for v in results.values() if v == UNKNOWN])
+    label = 'would change' if args.dry_run else 'changed'
+    print(f'-- Reconciled {len(targets)} instances in {time.monotonic() - started:.1f}s: {changed} {label}, {len(targets) - changed - failed - unknown} up to date, '
+          f'{failed} failed' + (f', {unknown} state unknown' if unknown > 0 else ''))
+
+    if failed > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    run()
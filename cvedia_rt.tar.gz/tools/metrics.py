@@ -0,0 +1,143 @@
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# minimal prometheus text exposition, no client library needed
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    def __init__(self, name, help, kind, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = list(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        # [(suffix, label values, extra label, value)]
+        with self.lock:
+            return [('', k, None, v) for k, v in self.values.items()]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, values, extra)} {format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, 'counter', labels)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, 'gauge', labels)
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, 'histogram', labels)
+        self.buckets = list(buckets) + [float('inf')]
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # per bucket counts, sum, count
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for k, le in enumerate(self.buckets):
+                if value <= le:
+                    entry[0][k] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for values, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for le, n in zip(self.buckets, counts):
+                    cumulative += n
+                    out.append(('_bucket', values, f'le="{format_value(le)}"', cumulative))
+                out.append(('_sum', values, None, total))
+                out.append(('_count', values, None, count))
+        return out
+
+class Callback(Metric):
+    """Metric read at scrape time, `fn` returns a dict of label values tuple -> value."""
+
+    def __init__(self, name, help, kind, labels, fn):
+        super().__init__(name, help, kind, labels)
+        self.fn = fn
+
+    def samples(self):
+        return [('', k, None, v) for k, v in self.fn().items()]
+
+def exposition():
+    lines = []
+    for metric in list(REGISTRY):
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+# shared by the bridge and the sinks
+MESSAGES_RECEIVED = Counter('bridge_messages_received_total', 'MQTT messages received', ['topic'])
+DECODE_FAILURES = Counter('bridge_decode_failures_total', 'MQTT messages that could not be decoded', ['topic'])
+RECONNECTS = Counter('bridge_reconnects_total', 'Connections re-established after being lost', ['target'])
+CONNECTED = Gauge('bridge_mqtt_connected', '1 while connected to the MQTT broker')
+REQUEST_SECONDS = Histogram('bridge_sink_request_seconds', 'Sink request latency in seconds', ['sink'])
+REQUEST_BYTES = Counter('bridge_sink_request_bytes_total', 'Bytes sent in sink request bodies, after compression', ['sink'])
+RESPONSES = Counter('bridge_sink_responses_total', 'Sink responses by status code, error when no response was received', ['sink', 'status'])
+REJECTED = Counter('bridge_sink_rejected_total', 'Events dropped because the sink rejected them with a 4xx response', ['sink'])
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        out = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+def serve(port, host='0.0.0.0'):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f'-- Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--metrics_port', type=int, default=0,
+        help='Serve prometheus metrics on this port, 0 to disable')
+    parser.add_argument(
+        '--metrics_host', type=str, default='0.0.0.0',
+        help='Address the metrics endpoint listens on')
@@ -1,13 +1,13 @@
 import os
 import sys
 import argparse
-import json
-import random
-import base64
-import requests
+import delivery_queue
+import metrics
+import bridge
+import frame_store
 
-from datetime import datetime
-from paho.mqtt import client as mqtt_client
+from bridge import Bridge, make_client_id
+from rest_sink import RestSink, ENCODINGS, COMPRESSIONS
 
 parser = argparse.ArgumentParser(description="Consumes a MQTT queue unwraps json object and sends it to a REST API")
 # mqtt
@@ -27,61 +27,80 @@ parser.add_argument(
 parser.add_argument(
     '-r', '--rest', type=str, default="http://127.0.0.1/dummy/api/",
     help='REST API endpoint')
+parser.add_argument(
+    '--timeout', type=float, default=10,
+    help='REST API request timeout in seconds')
 
-args = parser.parse_args()
-
-# generate client ID with pub prefix randomly
-client_id = f'python-mqtt-{random.randint(0, 99999999999)}'
+# request bodies
+parser.add_argument(
+    '--encoding', type=str, default='json', choices=ENCODINGS,
+    help='Request body encoding: json, raw forwards the MQTT payload unchanged, msgpack requires python3 -m pip install msgpack')
+parser.add_argument(
+    '--compress', type=str, default='none', choices=COMPRESSIONS,
+    help='Compress request bodies, zstd requires python3 -m pip install zstandard')
+parser.add_argument(
+    '--batch', type=int, default=1,
+    help='Maximum number of events posted in one request, as newline delimited json or a msgpack list')
+parser.add_argument(
+    '--batch_ms', type=float, default=0,
+    help='Milliseconds to wait for a batch to fill before posting it')
 
-def connect_mqtt() -> mqtt_client:
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print(f"Connected to MQTT Broker @ {args.mqtt}, waiting for messages...")
-        else:
-            print("Failed to connect, return code %d\n", rc)
+# spool
+parser.add_argument(
+    '--spool', type=str, default=None,
+    help='Directory used to store events on disk while the REST API is unavailable, disabled if not set')
+parser.add_argument(
+    '--spool_segment_mb', type=int, default=64,
+    help='Spool segment file size in MB')
+parser.add_argument(
+    '--spool_max_mb', type=int, default=0,
+    help='Maximum spool size in MB, oldest segments are discarded when exceeded, 0 for unlimited')
+parser.add_argument(
+    '--spool_rate', type=float, default=50,
+    help='Maximum number of spooled events replayed per second once the REST API recovers')
+parser.add_argument(
+    '--spool_retry', type=float, default=5,
+    help='Seconds to wait before retrying the REST API while it is unavailable')
 
-    client = mqtt_client.Client(client_id)
-    if args.username != None:
-        client.username_pw_set(args.username, args.password)
-    client.on_connect = on_connect
-    client.connect(args.mqtt, args.port)
-    return client
+# image offload
+frame_store.add_arguments(parser)
 
+# delivery, each worker is one in-flight request with its own keep-alive connection
+delivery_queue.add_arguments(parser, workers=4, short=True)
+metrics.add_arguments(parser)
+bridge.add_arguments(parser)
 
-def subscribe(client: mqtt_client):
-    def on_message(client, userdata, msg):
-        try:
-            data = json.loads(str(msg.payload.decode()))
-        except:
-            print(f"{datetime.now()} -- Failed to decode `{msg.payload.decode()}` from `{msg.topic}` topic, skipping")
-            return
+args = parser.parse_args()
 
-        print(f"{datetime.now()} -- Received `{data}` from `{msg.topic}` topic")
-        
-        try:
-            res = requests.post(
-                '{}'.format(args.rest),
-                json=data,
-                #headers={ 'Authorization': f'Bearer {args.auth}' },
-                verify=False
-            )
-            
-            print('\tResult:', res)
-        except:
-            print('\tFailed to send to REST API')
-        
-        
-    for tl in args.topic:
-        for tn in tl:
-            print(f"Subscribing to {tn}...")
-            client.subscribe(tn)
-    
-    client.on_message = on_message
+# unique per host and process, instances must not share a client ID
+client_id = args.client_id or make_client_id(stable=args.persistent, key=[args.topic, args.rest])
 
 def run():
-    client = connect_mqtt()
-    subscribe(client)
-    client.loop_forever()
+    try:
+        sink = RestSink(
+            url=args.rest,
+            timeout=args.timeout,
+            spool=args.spool,
+            spool_segment_mb=args.spool_segment_mb,
+            spool_max_mb=args.spool_max_mb,
+            spool_rate=args.spool_rate,
+            spool_retry=args.spool_retry,
+            encoding=args.encoding,
+            compress=args.compress,
+            batch=args.batch,
+            batch_ms=args.batch_ms,
+            workers=args.workers,
+            queue_size=args.queue_size,
+            overflow=args.overflow,
+            **frame_store.options(args)
+        )
+    except ValueError as e:
+        print(f'-- {e}')
+        sys.exit(1)
+    
+    topics = [tn for tl in args.topic for tn in tl]
+    Bridge([sink], topics, args.mqtt, args.port, args.username, args.password, client_id, args.queue_size, args.stats_interval,
+           args.metrics_port, args.metrics_host, **bridge.options(args)).run()
 
 if __name__ == '__main__':
     run()
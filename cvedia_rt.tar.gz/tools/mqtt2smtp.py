@@ -1,17 +1,13 @@
 import os
 import sys
 import argparse
-import json
-import random
-import base64
+import delivery_queue
+import metrics
+import bridge
+import frame_store
 
-from paho.mqtt import client as mqtt_client
-
-import smtplib
-
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
+from bridge import Bridge, make_client_id
+from smtp_sink import SmtpSink
 
 parser = argparse.ArgumentParser(description="Consumes a MQTT queue and sends emails out")
 # mqtt
@@ -42,78 +38,59 @@ parser.add_argument(
 parser.add_argument(
     '-T', '--smtp_to', type=str, default='cvedia@cvedia.com', help='SMTP receiver email')
 
-args = parser.parse_args()
-
-# generate client ID with pub prefix randomly
-client_id = f'python-mqtt-{random.randint(0, 99999999999)}'
-
-def connect_mqtt() -> mqtt_client:
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print("Connected to MQTT Broker @ {}".format(args.mqtt))
-        else:
-            print("Failed to connect, return code %d\n", rc)
-
-    client = mqtt_client.Client(client_id)
-    if args.username != None:
-        client.username_pw_set(args.username, args.password)
-    client.on_connect = on_connect
-    client.connect(args.mqtt, args.port)
-    return client
+parser.add_argument(
+    '--smtp_idle', type=float, default=60, help='Close pooled SMTP sessions idle for more than N seconds')
 
+# digest
+parser.add_argument(
+    '--digest', type=float, default=0,
+    help='Aggregate alarms per NVR S/N over a N seconds window into a single email, 0 sends one email per alarm')
+parser.add_argument(
+    '--digest_max', type=int, default=20,
+    help='Maximum number of alarms in a single digest email, a full digest is sent before its window ends')
 
-def subscribe(client: mqtt_client):
-    def on_message(client, userdata, msg):
-        try:
-            data = json.loads(json.loads(str(msg.payload.decode())))
-        except:
-            data = json.loads(str(msg.payload.decode()))
-        
-        # print(f"Received `{data}` from `{msg.topic}` topic")
-        
-        if args.smtp != None:
-            if 'nvr_sn' not in data:
-                data['nvr_sn'] = msg.topic
-            if 'alarm_name' not in data:
-                data['alarm_name'] = 'unknown'
-            
-            mail_content = '''NVR NAME:      {}
-NVR S/N:       {}
-ALARM NAME(NUM):    {} {}
-'''.format(data['frame_id'], data['nvr_sn'], data['alarm_name'], data['frame_id'])
-            
-            message = MIMEMultipart()
-            message['From'] = args.smtp_from
-            message['To'] = args.smtp_to
-            message['Subject'] = 'Alarm from NVR #{}'.format(data['nvr_sn'])
-            
-            #The body and the attachments for the mail
-            message.attach(MIMEText(mail_content, 'plain'))
-            message.attach(MIMEImage(base64.b64decode(data['image']), name='image.jpg'))
-            
-            #Create SMTP session for sending the mail
-            session = smtplib.SMTP(args.smtp, args.smtp_port)
-            session.starttls() # enable security
-            session.login(args.smtp_from, args.smtp_password)
-            
-            text = message.as_string()
-            session.sendmail(args.smtp_from, args.smtp_to, text)
-            session.quit()
+# image offload
+frame_store.add_arguments(parser)
 
-            print('-- Email sent to: {} subject: {}'.format(args.smtp_to, message['Subject']))
+# delivery
+parser.add_argument(
+    '--encoders', type=int, default=0,
+    help='Number of processes decoding images and building emails, 0 does it on the delivery workers')
+delivery_queue.add_arguments(parser)
+metrics.add_arguments(parser)
+bridge.add_arguments(parser)
 
-    for tl in args.topic:
-        for tn in tl:
-            print(f"Subscribing to {tn}...")
-            client.subscribe(tn)
-    
-    client.on_message = on_message
+args = parser.parse_args()
 
+# unique per host and process, instances must not share a client ID
+client_id = args.client_id or make_client_id(stable=args.persistent, key=[args.topic, args.smtp, args.smtp_to])
 
 def run():
-    client = connect_mqtt()
-    subscribe(client)
-    client.loop_forever()
+    sink = SmtpSink(
+        host=args.smtp,
+        port=args.smtp_port,
+        username=args.smtp_username,
+        password=args.smtp_password,
+        sender=args.smtp_from,
+        receiver=args.smtp_to,
+        idle_timeout=args.smtp_idle,
+        digest=args.digest,
+        digest_max=args.digest_max,
+        encoders=args.encoders,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        overflow=args.overflow,
+        **frame_store.options(args)
+    )
+    
+    topics = [tn for tl in args.topic for tn in tl]
+    try:
+        b = Bridge([sink], topics, args.mqtt, args.port, args.username, args.password, client_id, args.queue_size, args.stats_interval,
+                   args.metrics_port, args.metrics_host, **bridge.options(args))
+    except ValueError as e:
+        print(f'-- {e}')
+        sys.exit(1)
+    b.run()
 
 if __name__ == '__main__':
     run()
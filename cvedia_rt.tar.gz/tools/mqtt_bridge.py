@@ -0,0 +1,104 @@
+import os
+import sys
+import argparse
+import json
+
+from bridge import Bridge, create_sink, make_client_id
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+parser = argparse.ArgumentParser(description="Consumes a MQTT queue once and fans every message out to multiple REST / SMTP / NX Witness sinks configured from a file")
+parser.add_argument(
+    '-c', '--config', type=str, required=True,
+    help='Bridge configuration, json or yaml (requires pyyaml)')
+# mqtt, override the configuration
+parser.add_argument(
+    '-m', '--mqtt', type=str, default=None,
+    help='MQTT server ip')
+parser.add_argument(
+    '-p', '--port', type=int, default=None,
+    help='MQTT server port')
+parser.add_argument(
+    '-t', '--topic', type=str, action='append', nargs='+', help='MQTT topic(s)')
+parser.add_argument(
+    '-u', '--username', type=str, default=None, help='MQTT username')
+parser.add_argument(
+    '-P', '--password', type=str, default=None, help='MQTT password')
+parser.add_argument(
+    '--metrics_port', type=int, default=None,
+    help='Serve prometheus metrics on this port, overrides metrics.port, 0 to disable')
+parser.add_argument(
+    '--share', type=str, default=None,
+    help='Shared subscription group, overrides mqtt.share')
+parser.add_argument(
+    '--mqtt_v5', default=None, action='store_true',
+    help='Connect with MQTT v5, overrides mqtt.v5')
+parser.add_argument(
+    '--processes', type=int, default=None,
+    help='Number of bridge processes sharing the subscriptions, overrides processes')
+
+args = parser.parse_args()
+
+# unique per host and process, instances must not share a client ID
+client_id = make_client_id()
+
+def load_config(fn):
+    with open(fn) as f:
+        if fn.endswith('.yaml') or fn.endswith('.yml'):
+            if yaml is None:
+                print('-- yaml configurations require pyyaml: python3 -m pip install pyyaml')
+                sys.exit(1)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def run():
+    config = load_config(args.config)
+    mqtt = config.get('mqtt', {})
+    metrics = config.get('metrics', {})
+    
+    topics = config.get('topics', [])
+    if args.topic is not None:
+        topics = [tn for tl in args.topic for tn in tl]
+    
+    try:
+        sinks = [create_sink(c) for c in config.get('sinks', [])]
+    except (TypeError, ValueError) as e:
+        print(f'-- Invalid sink configuration: {e}')
+        sys.exit(1)
+    
+    if len(sinks) == 0:
+        print(f'-- No sinks configured in {args.config}')
+        sys.exit(1)
+    
+    print(f"-- Sinks: {', '.join(sink.name for sink in sinks)}")
+    
+    try:
+        b = Bridge(
+            sinks,
+            topics,
+            args.mqtt or mqtt.get('host', '127.0.0.1'),
+            args.port or mqtt.get('port', 1883),
+            args.username or mqtt.get('username'),
+            args.password or mqtt.get('password'),
+            mqtt.get('client_id') or (make_client_id(stable=True, key=[os.path.abspath(args.config), topics]) if mqtt.get('persistent') else client_id),
+            config.get('queue_size', 1000),
+            config.get('stats_interval', 60),
+            args.metrics_port if args.metrics_port is not None else metrics.get('port', 0),
+            metrics.get('host', '0.0.0.0'),
+            share=args.share or mqtt.get('share'),
+            mqtt_v5=args.mqtt_v5 or mqtt.get('v5', False),
+            processes=args.processes or config.get('processes', 1),
+            qos=mqtt.get('qos', 0),
+            persistent=mqtt.get('persistent', False),
+            max_inflight=mqtt.get('max_inflight', 100)
+        )
+    except ValueError as e:
+        print(f'-- {e}')
+        sys.exit(1)
+    b.run()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,169 @@
+import os
+import glob
+import gzip
+import json
+import base64
+import random
+import struct
+import time
+
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# capture segment: MAGIC followed by records of
+# header (receive timestamp, qos, retain, topic length, payload length) + topic bytes + payload bytes
+MAGIC = b'MQCAP1\n'
+HEADER = struct.Struct('>dBBHI')
+SUFFIXES = {
+    'none': '.cap',
+    'gzip': '.cap.gz',
+    'zstd': '.cap.zst',
+}
+
+def open_segment(fn, mode):
+    if fn.endswith(SUFFIXES['gzip']):
+        # fast compression, captures are about throughput not ratio
+        return gzip.open(fn, mode, compresslevel=1) if mode == 'wb' else gzip.open(fn, mode)
+    if fn.endswith(SUFFIXES['zstd']):
+        if zstandard is None:
+            raise RuntimeError('zstd captures require the zstandard package: python3 -m pip install zstandard')
+        if mode == 'wb':
+            return zstandard.ZstdCompressor(level=3).stream_writer(open(fn, 'wb'), closefd=True)
+        return zstandard.ZstdDecompressor().stream_reader(open(fn, 'rb'), closefd=True)
+    return open(fn, mode)
+
+class CaptureWriter:
+    """Writes raw MQTT messages to length-prefixed, optionally compressed segment files.
+
+    A new segment is started once `rotate_bytes` of payload were written or
+    `rotate_s` seconds passed, whichever comes first (0 disables either).
+    """
+
+    def __init__(self, path, prefix='mqtt', compress='gzip', rotate_bytes=256 * 1024 * 1024, rotate_s=3600):
+        if compress not in SUFFIXES:
+            raise ValueError(f'Unknown compression: {compress}')
+
+        self.path = path
+        self.prefix = prefix
+        self.suffix = SUFFIXES[compress]
+        self.rotate_bytes = rotate_bytes
+        self.rotate_s = rotate_s
+        self.segment = None
+        self.fn = None
+        self.seq = 0
+        self.messages = 0
+        self.bytes = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, ts, topic, payload, qos=0, retain=False):
+        if self.segment is None or self._should_rotate():
+            self.rotate()
+
+        topic = topic.encode()
+        self.segment.write(HEADER.pack(ts, qos, 1 if retain else 0, len(topic), len(payload)))
+        self.segment.write(topic)
+        self.segment.write(payload)
+        self.segment_bytes += HEADER.size + len(topic) + len(payload)
+        self.messages += 1
+        self.bytes += len(payload)
+
+    def rotate(self):
+        self.close()
+
+        # sequence keeps names unique when rotating more than once a second
+        self.fn = os.path.join(self.path, f'{self.prefix}-{datetime.now().strftime("%Y%m%d_%H%M%S")}-{self.seq:06d}{self.suffix}')
+        self.seq += 1
+        self.segment = open_segment(self.fn, 'wb')
+        self.segment.write(MAGIC)
+        self.segment_bytes = 0
+        self.segment_started = time.monotonic()
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def _should_rotate(self):
+        if self.rotate_bytes > 0 and self.segment_bytes >= self.rotate_bytes:
+            return True
+        return self.rotate_s > 0 and time.monotonic() - self.segment_started >= self.rotate_s
+
+def read_segment(fn):
+    # yields (timestamp, topic, payload, qos, retain), stops quietly at a truncated tail
+    with open_segment(fn, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{fn} is not a MQTT capture')
+
+        while True:
+            try:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                ts, qos, retain, topic_len, payload_len = HEADER.unpack(header)
+                topic = f.read(topic_len)
+                payload = f.read(payload_len)
+            except EOFError:
+                # compressed stream cut short, eg the capture was killed
+                return
+
+            if len(topic) < topic_len or len(payload) < payload_len:
+                return
+            yield ts, topic.decode(), payload, qos, retain == 1
+
+def list_segments(paths):
+    # accepts segment files and / or directories of segments, returns files in capture order
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for suffix in SUFFIXES.values():
+                files += glob.glob(os.path.join(path, f'*{suffix}'))
+        else:
+            files.append(path)
+    return sorted(set(files), key=lambda fn: os.path.basename(fn))
+
+def read_captures(paths):
+    for fn in list_segments(paths):
+        for record in read_segment(fn):
+            yield record
+
+def synthetic_payloads(image_kb=0, events=1, count=16, label=None):
+    """Pre-encoded messages shaped like CVEDIA-RT events.
+
+    Every message is returned as the parts around its frame id, fill it in
+    with `str(frame_id).encode().join(parts)` instead of re-serializing the
+    image. `label` replaces the random event labels and may contain
+    `{frame_id}` as well.
+    """
+
+    image = None
+    if image_kb > 0:
+        # jpeg magic so sinks guessing the image type accept it
+        image = base64.b64encode(b'\xff\xd8\xff\xe0' + os.urandom(image_kb * 1024)).decode()
+
+    payloads = []
+    for k in range(count):
+        data = {
+            "frame_id": "{frame_id}",
+            "frame_time": 0,
+            "events": [
+                {
+                    "type": random.choice(['intrusion', 'loitering', 'crossing', 'fallen']),
+                    "label": label or random.choice(['person', 'car', 'bicycle', 'truck']),
+                    "id": k * events + e,
+                    "confidence": round(random.uniform(0.5, 1), 3),
+                    "bbox": [round(random.random(), 3) for i in range(4)],
+                }
+                for e in range(events)
+            ],
+        }
+        if image is not None:
+            data['image'] = image
+
+        # the frame id is a number, its placeholder loses the quotes
+        payloads.append(json.dumps(data).encode().replace(b'"{frame_id}"', b'{frame_id}').split(b'{frame_id}'))
+    return payloads
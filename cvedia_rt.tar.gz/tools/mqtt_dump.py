@@ -1,11 +1,13 @@
-import os
-import sys
 import argparse
 import json
-import random
-import base64
+import time
+import threading
 
+from datetime import datetime
 from paho.mqtt import client as mqtt_client
+from bridge import create_client, make_client_id
+from delivery_queue import DeliveryQueue
+from mqtt_capture import CaptureWriter
 
 parser = argparse.ArgumentParser(description="Consumes a MQTT queue and prints its messages")
 # mqtt
@@ -22,10 +24,27 @@ parser.add_argument(
 parser.add_argument(
     '-P', '--password', type=str, default=None, help='MQTT password')
 
+# raw capture
+parser.add_argument(
+    '-o', '--output', type=str, default=None,
+    help='Directory to capture the raw messages to instead of printing them')
+parser.add_argument(
+    '--compress', type=str, default='gzip', choices=['gzip', 'zstd', 'none'],
+    help='Capture segment compression, zstd requires python3 -m pip install zstandard')
+parser.add_argument(
+    '--rotate_mb', type=int, default=256,
+    help='Start a new segment after this many MB, 0 to disable')
+parser.add_argument(
+    '--rotate_s', type=float, default=3600,
+    help='Start a new segment after this many seconds, 0 to disable')
+parser.add_argument(
+    '--buffer', type=int, default=10000,
+    help='Maximum number of messages waiting to be written, the MQTT loop blocks when full')
+
 args = parser.parse_args()
 
-# generate client ID with pub prefix randomly
-client_id = f'python-mqtt-{random.randint(0, 99999999999)}'
+# unique per host and process, instances must not share a client ID
+client_id = make_client_id()
 
 def connect_mqtt() -> mqtt_client:
     def on_connect(client, userdata, flags, rc):
@@ -34,7 +53,7 @@ def connect_mqtt() -> mqtt_client:
         else:
             print("Failed to connect, return code %d\n", rc)
 
-    client = mqtt_client.Client(client_id)
+    client = create_client(client_id)[0]
     if args.username != None:
         client.username_pw_set(args.username, args.password)
     client.on_connect = on_connect
@@ -42,10 +61,39 @@ def connect_mqtt() -> mqtt_client:
     return client
 
 
-def subscribe(client: mqtt_client):
+def capture(pending, writer):
+    last_report = time.monotonic()
+    
+    while True:
+        try:
+            topic, (ts, payload, qos, retain) = pending.get(timeout=1)
+        except TimeoutError:
+            topic = None
+        
+        if topic is not None:
+            try:
+                writer.write(ts, topic, payload, qos, retain)
+            except Exception as e:
+                print(f"{datetime.now()} -- Failed to capture message from `{topic}`: {e}")
+            finally:
+                pending.task_done()
+        
+        if time.monotonic() - last_report >= 10:
+            last_report = time.monotonic()
+            print(f"{datetime.now()} -- Captured {writer.messages} messages, {writer.bytes} bytes, pending: {pending.qsize()} segment: {writer.fn}")
+
+def subscribe(client: mqtt_client, pending):
     def on_message(client, userdata, msg):
+        if pending is not None:
+            # raw capture, no decoding on the network thread
+            pending.put(msg.topic, (time.time(), msg.payload, msg.qos, msg.retain))
+            return
+        
         #data = json.loads(json.loads(str(msg.payload.decode())))
-        data = json.loads(str(msg.payload.decode()))
+        try:
+            data = json.loads(msg.payload)
+        except:
+            data = msg.payload
         print(f"Received `{data}` from `{msg.topic}` topic")
         
     for tl in args.topic:
@@ -57,9 +105,24 @@ def subscribe(client: mqtt_client):
 
 
 def run():
+    pending = None
+    if args.output is not None:
+        pending = DeliveryQueue(args.buffer)
+        writer = CaptureWriter(args.output, compress=args.compress, rotate_bytes=args.rotate_mb * 1024 * 1024, rotate_s=args.rotate_s)
+        threading.Thread(target=capture, args=(pending, writer), name='capture', daemon=True).start()
+    
     client = connect_mqtt()
-    subscribe(client)
-    client.loop_forever()
+    subscribe(client, pending)
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        if pending is not None:
+            # flush what was received and close the segment so it's complete on disk
+            client.disconnect()
+            print(f"-- Writing {pending.qsize()} pending messages...")
+            pending.join()
+            writer.close()
+            print(f"-- Captured {writer.messages} messages, {writer.bytes} bytes")
 
 if __name__ == '__main__':
     run()
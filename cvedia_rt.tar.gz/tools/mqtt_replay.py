@@ -0,0 +1,199 @@
+import os
+import sys
+import argparse
+import time
+import queue
+import threading
+
+from collections import deque
+from datetime import datetime
+from paho.mqtt import client as mqtt_client
+from bridge import create_client
+from mqtt_capture import read_captures, synthetic_payloads
+
+parser = argparse.ArgumentParser(description="Replays mqtt_dump.py captures or synthetic CVEDIA-RT events to a MQTT broker and reports the achieved publish rate")
+# mqtt
+parser.add_argument(
+    '-m', '--mqtt', type=str, default='127.0.0.1',
+    help='MQTT server ip')
+parser.add_argument(
+    '-p', '--port', type=int, default=1883,
+    help='MQTT server port')
+parser.add_argument(
+    '-u', '--username', type=str, default=None, help='MQTT username')
+parser.add_argument(
+    '-P', '--password', type=str, default=None, help='MQTT password')
+parser.add_argument(
+    '-q', '--qos', type=int, default=None, choices=[0, 1, 2], help='Publish qos, defaults to the captured qos')
+
+# source
+parser.add_argument(
+    '-i', '--input', type=str, action='append', default=[],
+    help='Capture segment file or directory written by mqtt_dump.py -o, can be repeated')
+parser.add_argument(
+    '-g', '--synthetic', type=int, default=0,
+    help='Publish N synthetic CVEDIA-RT events instead of a capture')
+parser.add_argument(
+    '--synthetic_topics', type=int, default=10,
+    help='Number of topics the synthetic events are spread over')
+parser.add_argument(
+    '--image_kb', type=int, default=100,
+    help='Size of the synthetic event image in KB, 0 to leave it out')
+parser.add_argument(
+    '--events', type=int, default=1,
+    help='Number of events per synthetic message')
+parser.add_argument(
+    '-T', '--topic_prefix', type=str, default=None,
+    help='Prefix added to every published topic, eg: replay/')
+
+# pacing
+parser.add_argument(
+    '-s', '--speed', type=float, default=1,
+    help='Replay speed relative to the captured timing, eg 10 for 10x, 0 publishes as fast as possible')
+parser.add_argument(
+    '-r', '--rate', type=float, default=100,
+    help='Synthetic messages per second, 0 publishes as fast as possible')
+parser.add_argument(
+    '-l', '--loop', type=int, default=1,
+    help='Number of times the capture is replayed')
+
+# publishers
+parser.add_argument(
+    '-c', '--connections', type=int, default=1,
+    help='Number of concurrent publisher connections, messages of a topic always use the same connection')
+parser.add_argument(
+    '-W', '--window', type=int, default=1000,
+    help='Maximum number of unacknowledged publishes per connection')
+parser.add_argument(
+    '--report', type=float, default=1,
+    help='Print the achieved rate every N seconds')
+
+args = parser.parse_args()
+
+def connect_mqtt(k) -> mqtt_client:
+    def on_connect(client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Failed to connect publisher {k}, return code {rc}")
+
+    client = create_client(f'python-mqtt-replay-{os.getpid()}-{k}')[0]
+    if args.username != None:
+        client.username_pw_set(args.username, args.password)
+    client.on_connect = on_connect
+    client.connect(args.mqtt, args.port)
+    client.loop_start()
+    return client
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, size, ok):
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+            if not ok:
+                self.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            return self.messages, self.bytes, self.errors
+
+def settle(info, size, stats):
+    try:
+        info.wait_for_publish()
+        ok = info.rc == mqtt_client.MQTT_ERR_SUCCESS
+    except (RuntimeError, ValueError):
+        ok = False
+    stats.add(size, ok)
+
+def publisher(client, pending, stats):
+    inflight = deque()
+    while True:
+        item = pending.get()
+        if item is None:
+            break
+
+        topic, payload, qos = item
+        inflight.append((client.publish(topic, payload, qos), len(payload)))
+
+        # bound the memory held by paho when the broker can't keep up
+        while len(inflight) > args.window or (len(inflight) > 0 and inflight[0][0].is_published()):
+            settle(*inflight.popleft(), stats)
+
+    while len(inflight) > 0:
+        settle(*inflight.popleft(), stats)
+
+    client.disconnect()
+    client.loop_stop()
+
+def synthetic_source():
+    payloads = synthetic_payloads(args.image_kb, args.events)
+    interval = 1 / args.rate if args.rate > 0 else 0
+    for n in range(args.synthetic):
+        yield n * interval, f'cvedia/synthetic/{n % args.synthetic_topics}', str(n).encode().join(payloads[n % len(payloads)]), 0
+
+def capture_source():
+    # capture timestamps are rebased so every loop starts at 0
+    offset = 0
+    for i in range(args.loop):
+        first = None
+        last = 0
+        for ts, topic, payload, qos, retain in read_captures(args.input):
+            if first is None:
+                first = ts
+            last = ts - first
+            t = (last + offset) / args.speed if args.speed > 0 else 0
+            yield t, topic, payload, qos
+        offset += last
+
+def report(stats, started, final=False):
+    messages, size, errors = stats.snapshot()
+    elapsed = max(time.monotonic() - started, 1e-6)
+    label = 'Completed' if final else 'Progress'
+    print(f"{datetime.now()} -- {label}: {messages} messages, {size / 1024 / 1024:.1f} MB, {errors} errors in {elapsed:.1f}s, {messages / elapsed:.1f} msg/s {size / elapsed / 1024 / 1024:.2f} MB/s")
+
+def run():
+    if args.synthetic <= 0 and len(args.input) == 0:
+        print('-- Must specify a capture with -i or a number of synthetic messages with -g')
+        sys.exit(1)
+
+    source = synthetic_source() if args.synthetic > 0 else capture_source()
+    stats = Stats()
+
+    publishers = []
+    for k in range(max(1, args.connections)):
+        pending = queue.Queue(maxsize=args.window)
+        thread = threading.Thread(target=publisher, args=(connect_mqtt(k), pending, stats), name=f'publisher-{k}', daemon=True)
+        thread.start()
+        publishers.append((pending, thread))
+
+    print(f"-- Publishing to {args.mqtt}:{args.port} over {len(publishers)} connection(s)...")
+
+    started = time.monotonic()
+    last_report = started
+    for t, topic, payload, qos in source:
+        delay = started + t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        if args.topic_prefix is not None:
+            topic = args.topic_prefix + topic
+
+        publishers[hash(topic) % len(publishers)][0].put((topic, payload, qos if args.qos is None else args.qos))
+
+        if args.report > 0 and time.monotonic() - last_report >= args.report:
+            last_report = time.monotonic()
+            report(stats, started)
+
+    for pending, thread in publishers:
+        pending.put(None)
+    for pending, thread in publishers:
+        thread.join()
+
+    report(stats, started, True)
+
+if __name__ == '__main__':
+    run()
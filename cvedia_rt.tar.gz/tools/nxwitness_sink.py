@@ -0,0 +1,311 @@
+import json
+import time
+import threading
+import requests
+import metrics
+
+from requests.adapters import HTTPAdapter
+
+from datetime import datetime
+from bridge import Sink
+from topic_router import TopicRouter, load_routes
+
+class Coalescer:
+    """Tracks the open bookmark and last createEvent per (device, event type).
+
+    Events overlapping an open bookmark extend it instead of creating a new
+    one, createEvent is sent at most once per window for the same key.
+    Entries are forgotten once their bookmark ended more than a window ago.
+    """
+
+    def __init__(self, window_ms):
+        self.window = window_ms
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.last_purge = 0
+
+    def get(self, key, ref_ts):
+        with self.lock:
+            if ref_ts - self.last_purge > self.window:
+                self.entries = { k: e for k, e in self.entries.items() if ref_ts - e['end'] <= self.window }
+                self.last_purge = ref_ts
+            
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = { 'id': None, 'start': 0, 'end': 0, 'event': 0 }
+            return entry
+
+    def should_create_event(self, entry, ref_ts):
+        with self.lock:
+            if ref_ts - entry['event'] < self.window:
+                return False
+            entry['event'] = ref_ts
+            return True
+
+class NxClient:
+    """Keep-alive session to a NX Witness server.
+
+    The bearer token is cached and, when logged in with username and password,
+    a new session is created once less than `refresh` of its lifetime is left.
+    A request answered with 401 refreshes the token and is retried once.
+    """
+
+    def __init__(self, server, username, password, token, connections, timeout, refresh=0.1, name='nxwitness'):
+        self.name = name
+        self.server = server
+        self.username = username
+        self.password = password
+        self.token = token
+        self.timeout = timeout
+        self.refresh = refresh
+        self.refresh_at = None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=connections))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=connections))
+
+    def login(self):
+        # STEP 1
+        cloud_state = request_api(self.server, f'/rest/v1/login/users/{self.username}', 'GET', session=self.session)
+        if not is_local_user(cloud_state):
+            raise RuntimeError(self.username + ' is not a local user.')
+
+        # STEP 2
+        payload = create_local_payload(self.username, self.password)
+        session = request_api(self.server, '/rest/v1/login/sessions', 'POST', session=self.session, json=payload)
+
+        # STEP 3
+        token_info = request_api(self.server, f'/rest/v1/login/sessions/{session["token"]}', 'GET', session=self.session)
+        if is_expired(token_info):
+            raise RuntimeError('Expired token')
+
+        expires_in = int(token_info['expiresInS'])
+        self.token = session['token']
+        self.refresh_at = time.monotonic() + expires_in * (1 - self.refresh)
+        print(f'-- {datetime.now().isoformat()} Acquired bearer token from {self.server}, expires in {expires_in}s')
+
+    def headers(self):
+        if self.refresh_at is not None and time.monotonic() >= self.refresh_at:
+            self.renew(self.token)
+        return create_header(self.token)
+
+    def renew(self, token):
+        # only one worker refreshes, the others pick up the new token
+        with self.lock:
+            if self.username is None or token != self.token:
+                return
+            try:
+                self.login()
+            except Exception as e:
+                print(f'-- {datetime.now().isoformat()} Failed to refresh bearer token: {e}')
+                self.refresh_at = time.monotonic() + 10
+
+    def request(self, method, uri, **kwargs):
+        headers = self.headers()
+        res = self.timed(method, uri, headers, **kwargs)
+        if res.status_code == 401 and self.username is not None:
+            self.renew(headers['Authorization'][len('Bearer '):])
+            res = self.timed(method, uri, self.headers(), **kwargs)
+        return res
+
+    def timed(self, method, uri, headers, **kwargs):
+        started = time.monotonic()
+        try:
+            res = self.session.request(method, f'{self.server}{uri}', headers=headers, timeout=self.timeout, **kwargs)
+        except:
+            metrics.REQUEST_SECONDS.observe(time.monotonic() - started, self.name)
+            metrics.RESPONSES.inc(self.name, 'error')
+            raise
+        metrics.REQUEST_SECONDS.observe(time.monotonic() - started, self.name)
+        metrics.RESPONSES.inc(self.name, str(res.status_code))
+        return res
+
+def check_status(request, verbose):
+    if request.status_code == requests.codes.ok:
+        if verbose:
+            print("Request successful\n{0}".format(request.text))
+        return True
+    print(request.url + " Request error {0}\n{1}".format(request.status_code, request.text))
+    return False
+
+
+def request_api(url, uri, method, session=requests, **kwargs):
+    server_url = f'{url}{uri}'
+    response = session.request(
+        method,
+        server_url,
+        **kwargs
+    )
+    if not check_status(response, False):
+        raise RuntimeError(f'{server_url} returned {response.status_code}')
+    if method == 'DELETE':
+        return response
+    return response.json()
+
+def create_header(bearer_token):
+    header = {"Authorization": f"Bearer {bearer_token}"}
+    return header
+
+def print_system_info(response):
+    if 'reply' in response:
+        system_info = response['reply']
+        number_of_servers = len(system_info)
+        system_name = system_info[0]['systemName']
+    else:
+        system_info = response
+        number_of_servers = len(system_info)
+        system_name = system_info[0]['systemName']
+    print(f'System {system_name} contains {number_of_servers} server(s):')
+    print(system_info)
+
+def create_local_payload(user, password):
+    payload = {
+        'username': user,
+        'password': password,
+        'setCookie': False
+    }
+    return payload
+
+def is_local_user(api_response):
+    if api_response['username'] == 'admin':
+        return True
+    elif api_response['type'] == 'cloud':
+        return False
+
+
+def get_cloud_system_id(api_response):
+    cloud_system_id = api_response['cloudId']
+    return cloud_system_id
+
+def is_expired(api_response):
+    if int(api_response['expiresInS']) < 1:
+        return True
+    else:
+        return False
+
+class NxWitnessSink(Sink):
+    """Turns CVEDIA-RT events into NX Witness bookmarks and userDefinedEvents.
+
+    Topics are mapped to devices through `devices` (topic or pattern -> device
+    id) and / or a `device_map` json file, topics without a device use the
+    topic as device name. Devices are spread over the workers, the events of a
+    device are always delivered in order by the same worker.
+    """
+
+    sharded = True
+
+    def __init__(self, name='nxwitness', server='https://127.0.0.1:7001', username=None, password=None, auth=None,
+                 timeout=10, coalesce=0, devices=None, device_map=None, **kwargs):
+        # only the events are used, the image is never parsed
+        kwargs.setdefault('fields', ['events'])
+        super().__init__(name, **kwargs)
+        if auth == None and (username == None or password == None):
+            raise ValueError('Must specify either NX Witeness bearer auth or username and password')
+        
+        self.server = server
+        self.username = username if auth == None else None
+        self.password = password
+        self.auth = auth
+        self.timeout = timeout
+        self.coalescer = Coalescer(int(coalesce * 1000)) if coalesce > 0 else None
+        self.nx = None
+        
+        # topic -> device routing, resolved once per message
+        self.router = TopicRouter(devices)
+        if device_map != None:
+            for tn, device in load_routes(device_map).items():
+                self.router.add(tn, device)
+
+    def subscriptions(self):
+        return self.router.patterns
+
+    def start(self):
+        requests.packages.urllib3.disable_warnings()
+        self.nx = NxClient(self.server, self.username, self.password, self.auth, self.workers, self.timeout, name=self.name)
+        
+        if self.auth == None:
+            # print(f"Acquiring bearer token...")
+            self.nx.login()
+            
+            # STEP 4
+            system_info = request_api(self.server, f'/rest/v1/servers/*/info', 'GET', session=self.nx.session,
+                                    headers=self.nx.headers())
+            # print_system_info(system_info)
+            print(f'Sucessfully acquired bearer authentication token from {self.server}')
+
+    def key(self, topic, data):
+        return self.router.resolve(topic, topic)
+
+    def post_bookmark(self, device, i, ref_ts):
+        # https://localhost:7001/#/api-tool/rest-v1-devices-deviceid-bookmarks-post?version=current%20api
+        obj = {
+            "name": i['type'],
+            "description": i['label'],
+            "startTimeMs": ref_ts - 10000,
+            "creationTimeMs": ref_ts,
+            "durationMs": 30000,
+            "tags": [ i['type'] ]
+        }
+        
+        #print(f'-- event: {obj}')
+        
+        if self.coalescer is None:
+            return self.nx.request('POST', f'/rest/v1/devices/{device}/bookmarks', json=obj)
+        
+        entry = self.coalescer.get((device, i['type']), ref_ts)
+        end_ts = ref_ts + 20000
+        
+        if entry['id'] is not None and obj['startTimeMs'] <= entry['end']:
+            if end_ts <= entry['end']:
+                # already covered by the open bookmark
+                return None
+        
+            # extend ahead by a window so a steady stream of events only extends once per window
+            end_ts += self.coalescer.window
+            res = self.nx.request('PATCH', f'/rest/v1/devices/{device}/bookmarks/{entry["id"]}', json={ "durationMs": end_ts - entry['start'] })
+            if res.status_code == requests.codes.ok:
+                entry['end'] = end_ts
+                return res
+        
+        res = self.nx.request('POST', f'/rest/v1/devices/{device}/bookmarks', json=obj)
+        
+        try:
+            entry['id'] = res.json()['id']
+            entry['start'] = obj['startTimeMs']
+            entry['end'] = end_ts
+        except:
+            entry['id'] = None
+        return res
+
+    def deliver(self, topic, data, payload):
+        # topics without a device use the topic as device name
+        device = self.router.resolve(topic, topic)
+        
+        ref_ts = int( datetime.now().timestamp() * 1000 )
+        # translate mqtt message to nx witness event
+        for i in data['events']:
+            self.post_bookmark(device, i, ref_ts)
+        
+            if self.coalescer is not None:
+                entry = self.coalescer.get((device, i['type']), ref_ts)
+                if not self.coalescer.should_create_event(entry, ref_ts):
+                    continue
+        
+            obj = {
+                "timestamp": datetime.utcnow().isoformat() + 'Z',
+                "caption": i['type'],
+                "description": i['label'],
+                "eventType": "userDefinedEvent",
+                "eventResourceId": '{' + device + '}',
+                #"source": "demo",
+                "metadata": json.dumps({ "cameraRefs": [ '{' + device + '}' ] })
+            }
+        
+            #print(f'-- event: {obj}')
+        
+            res = self.nx.request('POST', '/api/createEvent', json=obj)
+        
+            print(f'-- {datetime.now().isoformat()} Event source: {topic} device: {device} caption: {i["type"]} return code: {res.status_code} text: {res.text}')
+        
+        # print(f"Received `{data}` from `{topic}` topic")
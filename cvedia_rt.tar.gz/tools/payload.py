@@ -0,0 +1,121 @@
+import re
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# string fields that can be cut out of the payload before parsing when no sink needs them decoded
+LARGE_FIELDS = ['image']
+
+# json strings and brackets, enough to know the depth of every key without parsing
+TOKENS = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+
+def loads(payload):
+    # parses straight from bytes, orjson when installed
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+def dumps(data):
+    # compact json bytes, orjson when installed
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+def backend():
+    return 'orjson' if orjson is not None else 'json'
+
+def cut_field(payload, field):
+    """Cuts the string value of `field` out of a json payload without parsing it.
+
+    Returns the payload with the value replaced by null and a memoryview of the
+    value (without quotes), or (payload, None) if the field isn't a plain
+    string. Only a top level `field` is cut, keys of the same name in nested
+    objects (eg the events) are left alone.
+    """
+
+    marker = b'"' + field.encode() + b'"'
+    if payload.find(marker) < 0:
+        return payload, None
+
+    depth = 0
+    for m in TOKENS.finditer(payload):
+        pos = m.start()
+        c = payload[pos]
+        if c == 0x7b or c == 0x5b:
+            depth += 1
+            continue
+        if c == 0x7d or c == 0x5d:
+            depth -= 1
+            continue
+        if depth != 1 or m.end() - pos != len(marker) or not payload.startswith(marker, pos):
+            continue
+
+        # skip whitespace around the colon, a marker not followed by one was a value, keep looking
+        start = m.end()
+        while start < len(payload) and payload[start] in b' \t\r\n':
+            start += 1
+        if start >= len(payload) or payload[start] != 0x3a:
+            continue
+        start += 1
+        while start < len(payload) and payload[start] in b' \t\r\n':
+            start += 1
+        if start >= len(payload) or payload[start] != 0x22:
+            return payload, None
+
+        start += 1
+        end = payload.find(b'"', start)
+        # escaped characters would need a real parser, base64 never has any
+        if end < 0 or payload.find(b'\\', start, end) >= 0:
+            return payload, None
+
+        return payload[:start - 1] + b'null' + payload[end + 1:], memoryview(payload)[start:end]
+
+    return payload, None
+
+def decode(payload, cut=()):
+    """Decodes a message, returning (data, raw).
+
+    Fields listed in `cut` are not parsed, `raw` maps them to a memoryview of
+    their value in the payload.
+    """
+
+    raw = {}
+    for field in cut:
+        stripped, value = cut_field(payload, field)
+        if value is not None:
+            payload = stripped
+            raw[field] = value
+
+    data = loads(payload)
+    # some publishers send the json document as a json encoded string
+    if isinstance(data, str):
+        data = loads(data)
+
+    if isinstance(data, dict):
+        for field in raw:
+            if field in data and data[field] is None:
+                del data[field]
+    return data, raw
+
+def project(data, raw, fields=None, raw_fields=()):
+    """Builds the view of a message a sink asked for.
+
+    `fields` lists the top level fields kept, None keeps all of them. Fields in
+    `raw_fields` are handed over as a memoryview when they were cut, as the
+    decoded value otherwise. The decoded message is never modified.
+    """
+
+    if not isinstance(data, dict) or (fields is None and len(raw) == 0):
+        return data
+
+    if fields is None:
+        view = dict(data)
+    else:
+        view = { k: data[k] for k in fields if k in data }
+    for field in raw_fields:
+        if field in raw:
+            view[field] = raw[field]
+    return view
@@ -0,0 +1,213 @@
+import os
+import gzip
+import time
+import threading
+import requests
+import metrics
+
+from requests.adapters import HTTPAdapter
+
+from datetime import datetime
+from bridge import Sink
+from payload import dumps
+from spool import Spool
+from frame_store import create_store, offload
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# request body encodings, raw forwards the MQTT payload as received
+ENCODINGS = ['json', 'raw', 'msgpack']
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+class RestSink(Sink):
+    """POSTs every message as json to a REST API.
+
+    Each worker keeps its own keep-alive session. With `spool` set, messages
+    that can't be delivered are stored on disk and replayed in order, at most
+    `spool_rate` per second, once the API recovers. With `frame_store` set
+    images are offloaded to a FrameStore and the message carries a reference.
+
+    `encoding` raw posts the MQTT payload unchanged, msgpack re-encodes the
+    message. With `batch` above 1 up to `batch` messages waiting at most
+    `batch_ms` are posted at once, as newline delimited json or a msgpack
+    list. Bodies are compressed with `compress` gzip or zstd.
+    """
+
+    def __init__(self, name='rest', url='http://127.0.0.1/dummy/api/', timeout=10,
+                 spool=None, spool_segment_mb=64, spool_max_mb=0, spool_rate=50, spool_retry=5,
+                 frame_store=None, frame_store_mb=1024, frame_url=None, frame_max_side=0, frame_quality=0,
+                 encoding='json', compress='none', batch=1, batch_ms=0,
+                 workers=4, **kwargs):
+        super().__init__(name, workers, **kwargs)
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding: {encoding}, must be one of: {", ".join(ENCODINGS)}')
+        if compress not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression: {compress}, must be one of: {", ".join(COMPRESSIONS)}')
+        if encoding == 'msgpack' and msgpack is None:
+            raise ValueError('msgpack encoding requires: python3 -m pip install msgpack')
+        if compress == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires: python3 -m pip install zstandard')
+        if encoding == 'raw' and frame_store is not None:
+            raise ValueError('raw encoding forwards the payload unchanged, images can not be offloaded')
+        self.url = url
+        self.timeout = timeout
+        self.spool_path = spool
+        self.spool_segment_mb = spool_segment_mb
+        self.spool_max_mb = spool_max_mb
+        self.spool_rate = spool_rate
+        self.spool_retry = spool_retry
+        self.spool = None
+        self.sessions = threading.local()
+        self.encoding = encoding
+        self.compress = compress
+        self.batch_size = max(1, batch)
+        self.batch_linger = batch_ms / 1000
+        # the payload is posted as received, nothing needs decoding
+        self.raw = encoding == 'raw'
+        self.frame_options = {
+            'frame_store': frame_store,
+            'frame_store_mb': frame_store_mb,
+            'frame_url': frame_url,
+            'frame_max_side': frame_max_side,
+            'frame_quality': frame_quality,
+        }
+        self.frames = None
+        if frame_store is not None:
+            # the image is never posted, no need to parse it
+            self.raw_fields = ('image',)
+        # set while the REST API is failing, events go straight to the spool instead
+        self.sink_down = threading.Event()
+
+    def forked(self, index):
+        # a spool has a single writer, every process gets its own
+        if self.spool_path is not None:
+            self.spool_path = os.path.join(self.spool_path, f'process-{index}')
+
+    def start(self):
+        requests.packages.urllib3.disable_warnings()
+        self.frames = create_store(**self.frame_options)
+        if self.spool_path is not None:
+            self.spool = Spool(self.spool_path, self.spool_segment_mb * 1024 * 1024, max_bytes=self.spool_max_mb * 1024 * 1024)
+            if not self.spool.empty():
+                print(f'-- Spool {self.spool_path} has {self.spool.pending_bytes()} bytes pending delivery')
+                self.sink_down.set()
+            threading.Thread(target=self.drain_spool, name=f'{self.name}-spool', daemon=True).start()
+
+    def get_session(self):
+        # one session per worker, connections are kept alive between requests
+        if not hasattr(self.sessions, 'session'):
+            session = requests.Session()
+            session.verify = False
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self.sessions.session = session
+        return self.sessions.session
+
+    def encode(self, events):
+        # events are (data, payload) tuples, returns the body and its content type
+        if self.encoding == 'msgpack':
+            data = [data for data, payload in events]
+            return msgpack.packb(data if self.batch_size > 1 else data[0]), 'application/msgpack'
+
+        if self.encoding == 'raw':
+            docs = [payload for data, payload in events]
+        else:
+            docs = [dumps(data) for data, payload in events]
+        if self.batch_size == 1:
+            return docs[0], 'application/octet-stream' if self.encoding == 'raw' else 'application/json'
+        # one document per line, raw payloads may be pretty printed
+        return b''.join(doc.replace(b'\r', b' ').replace(b'\n', b' ') + b'\n' for doc in docs), 'application/x-ndjson'
+
+    def compressed(self, body, headers):
+        if self.compress == 'gzip':
+            headers['Content-Encoding'] = 'gzip'
+            return gzip.compress(body, 6)
+        if self.compress == 'zstd':
+            # compressors aren't thread safe, one per worker
+            if not hasattr(self.sessions, 'zstd'):
+                self.sessions.zstd = zstandard.ZstdCompressor(level=3)
+            headers['Content-Encoding'] = 'zstd'
+            return self.sessions.zstd.compress(body)
+        return body
+
+    def post(self, events):
+        if self.frames is not None:
+            events = [(offload(self.frames, data), payload) for data, payload in events]
+        
+        started = time.monotonic()
+        try:
+            body, content_type = self.encode(events)
+            headers = { 'Content-Type': content_type }
+            #headers['Authorization'] = f'Bearer {args.auth}'
+            body = self.compressed(body, headers)
+            res = self.get_session().post(
+                self.url,
+                data=body,
+                headers=headers,
+                timeout=self.timeout
+            )
+
+            metrics.REQUEST_SECONDS.observe(time.monotonic() - started, self.name)
+            metrics.REQUEST_BYTES.inc(self.name, amount=len(body))
+            metrics.RESPONSES.inc(self.name, str(res.status_code))
+            print('\tResult:', res)
+            if 400 <= res.status_code < 500:
+                # rejected, sending the same event again would fail the same way
+                metrics.REJECTED.inc(self.name, amount=len(events))
+                print(f'\tDropped {len(events)} event(s), rejected by the REST API: {res.text[:200]}')
+            return res.status_code < 500
+        except:
+            metrics.REQUEST_SECONDS.observe(time.monotonic() - started, self.name)
+            metrics.RESPONSES.inc(self.name, 'error')
+            print('\tFailed to send to REST API')
+            return False
+
+    def deliver(self, topic, data, payload):
+        self.deliver_batch([(topic, data, payload)])
+
+    def deliver_batch(self, items):
+        for topic, data, payload in items:
+            if self.encoding == 'raw':
+                print(f"{datetime.now()} -- Received {len(payload)} bytes from `{topic}` topic")
+            else:
+                print(f"{datetime.now()} -- Received `{data}` from `{topic}` topic")
+
+        events = [(data, payload) for topic, data, payload in items]
+        if self.spool is not None:
+            if self.sink_down.is_set() or not self.post(events):
+                self.sink_down.set()
+                for topic, data, payload in items:
+                    self.spool.append(topic, payload)
+                print(f'\tSpooled, {self.spool.pending_bytes()} bytes pending')
+        else:
+            self.post(events)
+
+    def drain_spool(self):
+        # replays spooled events in order, at most spool_rate per second
+        while True:
+            record = self.spool.peek()
+            if record is None:
+                self.spool.sync()
+                time.sleep(0.5)
+                continue
+
+            topic, payload = record
+            print(f"{datetime.now()} -- Replaying spooled event from `{topic}` topic")
+            data = None if self.raw else self.view(payload)
+            if self.post([(data, payload)]):
+                self.spool.ack()
+                if self.spool.empty():
+                    self.sink_down.clear()
+                if self.spool_rate > 0:
+                    time.sleep(1 / self.spool_rate)
+            else:
+                self.sink_down.set()
+                time.sleep(self.spool_retry)
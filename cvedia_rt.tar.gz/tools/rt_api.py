@@ -0,0 +1,174 @@
+import json
+import time
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+
+# instance states reported by /api/instance/get
+STATE_ERROR = 2
+STATE_RUNNING = 4
+
+class ApiError(RuntimeError):
+    pass
+
+class RtApi:
+    """Keep-alive client for the CVEDIA-RT REST API, safe to share between threads.
+
+    `connections` bounds the number of pooled connections, set it to the
+    number of threads using the client.
+    """
+
+    def __init__(self, api='http://127.0.0.1:8080', connections=10, timeout=30, verbose=False):
+        self.api = api.rstrip('/')
+        self.timeout = timeout
+        self.verbose = verbose
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+
+    def request(self, uri, method='GET', check=True, **kwargs):
+        # with check the json response is returned and error codes raise ApiError, the raw response otherwise
+        url = f'{self.api}{uri}'
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            raise ApiError(f'Request to {url} failed: {e}')
+
+        if check == False:
+            return response
+
+        if response.status_code > 299:
+            raise ApiError(f'Error code: {response.status_code} response: {response.text}')
+
+        try:
+            output = response.json()
+        except ValueError:
+            raise ApiError(f'Invalid json response from {url}: {response.text[:200]}')
+
+        if self.verbose:
+            print(f'-- API Request to: {url} response: {json.dumps(output)}')
+
+        return output
+
+    def instances(self):
+        return self.request('/api/instance/get')
+
+def find_instance(instances, solution, name):
+    for r in instances:
+        try:
+            if r['instance_name'] == name and r['solution'] == solution:
+                return r
+        except:
+            pass
+    return None
+
+class StatePoller:
+    """Shared instance state poller, one /api/instance/get per tick for every waiter.
+
+    The listing is indexed by (solution, instance_name) and waiters are woken
+    after every fetch. The tick starts at `min_interval` and backs off up to
+    `max_interval` while no instance changes, nothing is polled while there
+    are no waiters.
+    """
+
+    def __init__(self, api, min_interval=0.25, max_interval=2, backoff=1.5):
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.cond = threading.Condition()
+        self.poke = threading.Event()
+        self.index = {}
+        # ids of the last fetch started / completed
+        self.started = 0
+        self.generation = 0
+        self.waiters = 0
+        self.fetches = 0
+        self.thread = None
+
+    def wait(self, solution, name, predicate, timeout):
+        """Blocks until `predicate` accepts the instance (None while it doesn't exist).
+
+        Only listings requested after the call are considered. Returns the
+        instance, raises TimeoutError once `timeout` seconds passed.
+        """
+
+        key = (solution, name)
+        return self.wait_index(lambda index: predicate(index.get(key)), timeout).get(key)
+
+    def wait_index(self, predicate, timeout):
+        # same as wait with a predicate over the whole index, returns the index
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.waiters += 1
+            # a fetch already in flight may predate the caller's last request
+            generation = self.started
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='state-poller', daemon=True)
+                self.thread.start()
+            # poll soon for a new waiter, waking the poller if it went idle
+            self.interval = self.min_interval
+            if self.waiters == 1:
+                self.cond.notify_all()
+        self.poke.set()
+
+        try:
+            with self.cond:
+                while True:
+                    if self.generation > generation:
+                        if predicate(self.index):
+                            return self.index
+                        generation = self.generation
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError()
+                    self.cond.wait(remaining)
+        finally:
+            with self.cond:
+                self.waiters -= 1
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.waiters > 0)
+                self.started += 1
+                fetch = self.started
+
+            try:
+                instances = self.api.instances()
+            except (ApiError, ValueError):
+                instances = None
+
+            with self.cond:
+                if instances is not None:
+                    index = {}
+                    for r in instances:
+                        try:
+                            index[(r['solution'], r['instance_name'])] = r
+                        except (KeyError, TypeError):
+                            pass
+
+                    states = lambda idx: { k: r.get('state') for k, r in idx.items() }
+                    changed = states(index) != states(self.index)
+                    self.index = index
+                    self.generation = fetch
+                    self.fetches += 1
+                    self.cond.notify_all()
+                else:
+                    changed = False
+
+                self.interval = self.min_interval if changed else min(self.max_interval, self.interval * self.backoff)
+
+            # at most one fetch per min_interval, new waiters cut the backoff short.
+            # cleared before sleeping, a waiter arriving during the sleep still pokes
+            self.poke.clear()
+            time.sleep(self.min_interval)
+            with self.cond:
+                # new waiters reset the interval
+                interval = self.interval
+            self.poke.wait(max(0, interval - self.min_interval))
@@ -0,0 +1,239 @@
+import base64
+import time
+import threading
+import smtplib
+import metrics
+
+from concurrent.futures import ProcessPoolExecutor
+
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+
+from bridge import Sink
+from frame_store import create_store, offload
+
+class SmtpPool:
+    """Authenticated SMTP sessions reused across emails.
+
+    Sessions idle for longer than `idle_timeout` are closed, a session dropped
+    by the server is replaced by a fresh one and the email is retried once.
+    """
+
+    def __init__(self, host, port, username, password, idle_timeout, name='smtp'):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def send(self, sender, receiver, text):
+        for retry in [True, False]:
+            session = self._acquire()
+            started = time.monotonic()
+            try:
+                session.sendmail(sender, receiver, text)
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+                self._close(session)
+                metrics.RESPONSES.inc(self.name, 'error')
+                if retry:
+                    print('-- SMTP session lost, reconnecting...')
+                    metrics.RECONNECTS.inc(self.name)
+                    continue
+                raise
+            except:
+                self._close(session)
+                metrics.RESPONSES.inc(self.name, 'error')
+                raise
+            
+            metrics.REQUEST_SECONDS.observe(time.monotonic() - started, self.name)
+            metrics.RESPONSES.inc(self.name, 'ok')
+            with self.lock:
+                self.idle.append((session, time.monotonic()))
+            return
+
+    def _acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            stale = [s for s, last_used in self.idle if now - last_used >= self.idle_timeout]
+            self.idle = [(s, last_used) for s, last_used in self.idle if now - last_used < self.idle_timeout]
+            session = self.idle.pop()[0] if len(self.idle) > 0 else None
+        
+        for s in stale:
+            self._close(s)
+        
+        if session is None:
+            session = smtplib.SMTP(self.host, self.port)
+            session.starttls() # enable security
+            session.login(self.username, self.password)
+        return session
+
+    def _close(self, session):
+        try:
+            session.quit()
+        except:
+            pass
+
+class Digest:
+    """Groups alarms per NVR S/N and sends them as a single email once the window elapses."""
+
+    def __init__(self, window, max_alarms, deliver):
+        self.window = window
+        self.max_alarms = max(1, max_alarms)
+        self.deliver = deliver
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, data):
+        full = None
+        with self.lock:
+            started, alarms = self.pending.setdefault(data['nvr_sn'], (time.monotonic(), []))
+            alarms.append(data)
+            if len(alarms) >= self.max_alarms:
+                full = self.pending.pop(data['nvr_sn'])[1]
+        
+        if full is not None:
+            self.deliver(full)
+
+    def run(self):
+        while True:
+            time.sleep(min(1, self.window / 4))
+            now = time.monotonic()
+            with self.lock:
+                expired = [sn for sn, (started, alarms) in self.pending.items() if now - started >= self.window]
+                ready = [self.pending.pop(sn)[1] for sn in expired]
+            
+            for alarms in ready:
+                try:
+                    self.deliver(alarms)
+                except Exception as e:
+                    print(f'-- Failed to send digest for NVR #{alarms[0]["nvr_sn"]}: {e}')
+
+def parse_alarm(topic, data):
+    # copy, the decoded message is shared with the other sinks
+    data = dict(data)
+    
+    if 'nvr_sn' not in data:
+        data['nvr_sn'] = topic
+    if 'alarm_name' not in data:
+        data['alarm_name'] = 'unknown'
+    
+    return data
+
+def render_email(alarms, sender, receiver):
+    mail_content = ''
+    for data in alarms:
+        mail_content += '''NVR NAME:      {}
+NVR S/N:       {}
+ALARM NAME(NUM):    {} {}
+'''.format(data['frame_id'], data['nvr_sn'], data['alarm_name'], data['frame_id'])
+        if 'image_ref' in data:
+            mail_content += 'IMAGE:         {}\n'.format(data['image_ref']['url'])
+    
+    message = MIMEMultipart()
+    message['From'] = sender
+    message['To'] = receiver
+    if len(alarms) == 1:
+        message['Subject'] = 'Alarm from NVR #{}'.format(alarms[0]['nvr_sn'])
+    else:
+        message['Subject'] = '{} alarms from NVR #{}'.format(len(alarms), alarms[0]['nvr_sn'])
+    
+    #The body and the attachments for the mail
+    message.attach(MIMEText(mail_content, 'plain'))
+    for k, data in enumerate(alarms):
+        if 'image' not in data:
+            continue
+        name = 'image.jpg' if len(alarms) == 1 else f'image_{k + 1}.jpg'
+        # decoded only here, with encoders the parent process never holds the image
+        message.attach(MIMEImage(base64.b64decode(data['image']), 'jpeg', name=name))
+    
+    return message['Subject'], message.as_bytes()
+
+def prepare_email(topic, data, sender, receiver):
+    return render_email([parse_alarm(topic, data)], sender, receiver)
+
+class SmtpSink(Sink):
+    """Emails every alarm, with its image attached, through a pool of SMTP sessions.
+
+    With `digest` set alarms are grouped per NVR S/N over that many seconds.
+    Decoding images and building emails runs on the delivery workers or, with
+    `encoders` set, on a process pool. With `frame_store` set images are
+    offloaded to a FrameStore and emails link to them instead of attaching them.
+    """
+
+    # base64 decoded straight from the payload bytes
+    raw_fields = ('image',)
+
+    def __init__(self, name='smtp', host=None, port=587, username=None, password=None,
+                 sender='cvedia@cvedia.com', receiver='cvedia@cvedia.com', idle_timeout=60,
+                 digest=0, digest_max=20, encoders=0,
+                 frame_store=None, frame_store_mb=1024, frame_url=None, frame_max_side=0, frame_quality=0, **kwargs):
+        super().__init__(name, **kwargs)
+        self.host = host
+        self.port = port
+        self.username = username or sender
+        self.password = password
+        self.sender = sender
+        self.receiver = receiver
+        self.idle_timeout = idle_timeout
+        self.digest_window = digest
+        # digests are sent once their window elapsed, long after the alarms were delivered
+        self.deferred = digest > 0
+        self.digest_max = digest_max
+        self.encoders = encoders
+        self.smtp_pool = None
+        self.digest = None
+        self.encoder_pool = None
+        self.frame_options = {
+            'frame_store': frame_store,
+            'frame_store_mb': frame_store_mb,
+            'frame_url': frame_url,
+            'frame_max_side': frame_max_side,
+            'frame_quality': frame_quality,
+        }
+        self.frames = None
+
+    def start(self):
+        if self.host == None:
+            return
+        
+        self.frames = create_store(**self.frame_options)
+        if self.encoders > 0:
+            self.encoder_pool = ProcessPoolExecutor(self.encoders)
+        self.smtp_pool = SmtpPool(self.host, self.port, self.username, self.password, self.idle_timeout, self.name)
+        if self.digest_window > 0:
+            self.digest = Digest(self.digest_window, self.digest_max, self.send_digest)
+            threading.Thread(target=self.digest.run, name=f'{self.name}-digest', daemon=True).start()
+
+    def encode(self, fn, *args):
+        # runs cpu heavy work on the encoder processes if enabled
+        if self.encoder_pool is not None:
+            return self.encoder_pool.submit(fn, *args).result()
+        return fn(*args)
+
+    def send(self, subject, text):
+        self.smtp_pool.send(self.sender, self.receiver, text)
+        
+        print('-- Email sent to: {} subject: {}'.format(self.receiver, subject))
+
+    def send_digest(self, alarms):
+        self.send(*self.encode(render_email, alarms, self.sender, self.receiver))
+
+    def deliver(self, topic, data, payload):
+        if self.host == None:
+            return
+        
+        if self.frames is not None:
+            data = offload(self.frames, data)
+        elif self.encoder_pool is not None and isinstance(data.get('image'), memoryview):
+            # memoryviews can't be sent to the encoder processes
+            data = dict(data, image=data['image'].tobytes())
+        
+        if self.digest is not None:
+            # images are decoded once the digest is rendered, in a single encoder call
+            self.digest.add(parse_alarm(topic, data))
+        else:
+            self.send(*self.encode(prepare_email, topic, data, self.sender, self.receiver))
@@ -0,0 +1,209 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+from datetime import datetime
+
+# record layout: header + topic bytes + payload bytes
+# header: topic length, payload length, crc32 of topic + payload
+HEADER = struct.Struct('>HII')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+class Spool:
+    """Segmented append-only on-disk log of (topic, payload) records.
+
+    Records are appended to the newest segment, which is rotated once it grows
+    over `segment_bytes`. Appends are flushed to the OS straight away but only
+    fsync'ed every `sync_interval` seconds. The reader walks the segments in
+    order with `peek` / `ack`, fully delivered segments are deleted and the
+    read position is persisted in a cursor file, so a restart resumes where
+    delivery stopped instead of re-reading what was already sent.
+
+    If `max_bytes` is set, the oldest segments are discarded once the spool
+    grows over it.
+    """
+
+    def __init__(self, path, segment_bytes=64 * 1024 * 1024, sync_interval=1.0, max_bytes=0):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.dropped_segments = 0
+
+        os.makedirs(path, exist_ok=True)
+
+        self.segments = sorted(int(fn[:-len(SEGMENT_SUFFIX)]) for fn in os.listdir(path) if fn.endswith(SEGMENT_SUFFIX))
+        self.sizes = { seq: os.path.getsize(self._segment_path(seq)) for seq in self.segments }
+
+        # read position, segments left over from a previous run are only read, never appended to
+        self.read_seq, self.read_offset = self._load_cursor()
+        self.reader = None
+        self.next_record = None
+        self.cursor_dirty = False
+
+        # always start a fresh segment, the tail of the previous one might be torn
+        self.writer = None
+        self._rotate()
+        self.last_sync = time.monotonic()
+
+    def append(self, topic, payload):
+        topic = topic.encode()
+        header = HEADER.pack(len(topic), len(payload), zlib.crc32(payload, zlib.crc32(topic)))
+
+        with self.lock:
+            if self.sizes[self.write_seq] >= self.segment_bytes:
+                self._rotate()
+
+            self.writer.write(header)
+            self.writer.write(topic)
+            self.writer.write(payload)
+            self.writer.flush()
+            self.sizes[self.write_seq] += HEADER.size + len(topic) + len(payload)
+
+            if self.max_bytes > 0:
+                self._enforce_limit()
+
+            self._maybe_sync()
+
+    def peek(self):
+        # oldest undelivered (topic, payload) or None if everything was delivered
+        with self.lock:
+            if self.next_record is None:
+                self.next_record = self._read_next()
+            if self.next_record is None:
+                return None
+            return self.next_record[0], self.next_record[1]
+
+    def ack(self):
+        # mark the record returned by the last `peek` as delivered
+        with self.lock:
+            if self.next_record is None:
+                return
+            self.read_offset = self.next_record[2]
+            self.next_record = None
+            self.cursor_dirty = True
+            self._maybe_sync()
+
+    def pending_bytes(self):
+        with self.lock:
+            return sum(self.sizes.values()) - self.read_offset
+
+    def empty(self):
+        return self.peek() is None
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.writer.close()
+            if self.reader is not None:
+                self.reader.close()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, f'{seq:012d}{SEGMENT_SUFFIX}')
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                seq, offset = f.read().split()
+                seq, offset = int(seq), int(offset)
+        except (OSError, ValueError):
+            seq, offset = -1, 0
+
+        # the cursor segment might have been deleted after it was written
+        if seq not in self.sizes:
+            seq = self.segments[0] if len(self.segments) > 0 else -1
+            offset = 0
+        return seq, offset
+
+    def _save_cursor(self):
+        tmp = os.path.join(self.path, CURSOR_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(f'{self.read_seq} {self.read_offset}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, CURSOR_FILE))
+        self.cursor_dirty = False
+
+    def _rotate(self):
+        if self.writer is not None:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+
+        self.write_seq = self.segments[-1] + 1 if len(self.segments) > 0 else 0
+        self.writer = open(self._segment_path(self.write_seq), 'ab')
+        self.segments.append(self.write_seq)
+        self.sizes[self.write_seq] = 0
+
+        if self.read_seq < 0:
+            self.read_seq, self.read_offset = self.write_seq, 0
+
+    def _read_next(self):
+        while True:
+            if self.reader is None:
+                self.reader = open(self._segment_path(self.read_seq), 'rb')
+                self.reader.seek(self.read_offset)
+
+            header = self.reader.read(HEADER.size)
+            if len(header) == HEADER.size:
+                topic_len, payload_len, crc = HEADER.unpack(header)
+                topic = self.reader.read(topic_len)
+                payload = self.reader.read(payload_len)
+                if len(topic) == topic_len and len(payload) == payload_len:
+                    if zlib.crc32(payload, zlib.crc32(topic)) == crc:
+                        return topic.decode(), payload, self.reader.tell()
+                    print(f'{datetime.now()} -- Spool: corrupted record in segment {self.read_seq} @ {self.read_offset}, skipping rest of segment')
+                elif self.read_seq == self.write_seq:
+                    # record is still being written
+                    self.reader.seek(self.read_offset)
+                    return None
+            elif self.read_seq == self.write_seq:
+                self.reader.seek(self.read_offset)
+                return None
+
+            # end of a sealed segment, everything in it was delivered
+            if self.read_seq == self.write_seq:
+                self._rotate()
+            self._drop_segment(self.read_seq)
+
+    def _drop_segment(self, seq):
+        if seq == self.read_seq:
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+            self.next_record = None
+            self.read_seq = self.segments[self.segments.index(seq) + 1]
+            self.read_offset = 0
+            self.cursor_dirty = True
+
+        self.segments.remove(seq)
+        del self.sizes[seq]
+        os.remove(self._segment_path(seq))
+
+        if self.cursor_dirty:
+            self._save_cursor()
+
+    def _enforce_limit(self):
+        while sum(self.sizes.values()) > self.max_bytes and self.segments[0] != self.write_seq:
+            self.dropped_segments += 1
+            print(f'{datetime.now()} -- Spool over {self.max_bytes} bytes, discarding oldest segment {self.segments[0]}')
+            self._drop_segment(self.segments[0])
+
+    def _maybe_sync(self):
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self._sync()
+
+    def _sync(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        if self.cursor_dirty:
+            self._save_cursor()
+        self.last_sync = time.monotonic()
@@ -0,0 +1,74 @@
+import json
+
+class TopicRouter:
+    """Maps MQTT topics to values, eg NX Witness device ids.
+
+    Plain topics are looked up in a dict, topics containing `+` / `#`
+    wildcards are stored in a trie walked level by level. When several
+    routes match, literal levels win over `+`, which wins over `#`.
+    """
+
+    def __init__(self, routes=None):
+        self.exact = {}
+        self.trie = {}
+        self.patterns = []
+        for topic, value in (routes or {}).items():
+            self.add(topic, value)
+
+    def add(self, topic, value):
+        self.patterns.append(topic)
+        if '+' not in topic and '#' not in topic:
+            self.exact[topic] = value
+            return
+
+        node = self.trie
+        for level in topic.split('/'):
+            node = node.setdefault(level, {})
+        node[None] = value
+
+    def resolve(self, topic, default=None):
+        value = self.exact.get(topic)
+        if value is not None:
+            return value
+        if len(self.trie) == 0:
+            return default
+
+        value = self._match(self.trie, topic.split('/'), 0)
+        return default if value is None else value
+
+    def _match(self, node, levels, k):
+        if k == len(levels):
+            if None in node:
+                return node[None]
+            # `a/#` also matches `a`
+            child = node.get('#')
+            return child.get(None) if child is not None else None
+
+        # wildcards don't match the first level of $SYS style topics
+        if k == 0 and levels[0].startswith('$'):
+            child = node.get(levels[0])
+            return self._match(child, levels, 1) if child is not None else None
+
+        for key in [levels[k], '+']:
+            child = node.get(key)
+            if child is not None:
+                value = self._match(child, levels, k + 1)
+                if value is not None:
+                    return value
+
+        child = node.get('#')
+        if child is not None:
+            return child.get(None)
+        return None
+
+    def __len__(self):
+        return len(self.patterns)
+
+def load_routes(fn):
+    # json object of { "topic or pattern": "value" }
+    with open(fn) as f:
+        routes = json.load(f)
+
+    if not isinstance(routes, dict):
+        raise ValueError(f'{fn} must contain a json object mapping topics to values')
+    return routes